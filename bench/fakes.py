@@ -0,0 +1,149 @@
+"""A fake Api and a synthetic MediaMonkey library for the benchmarks in this directory.
+
+Nothing here talks to Google Music; gmusicapi still needs to be installed, since the service imports it."""
+
+import os
+import sys
+import time
+import sqlite3
+import logging
+import threading
+import itertools
+from contextlib import closing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from sync2gm import service
+from sync2gm.iddb import create_tables
+from sync2gm.mediamonkey import make_connection, config as mm_config
+
+
+#The MediaMonkey tables the handlers read.
+schema_sql = """
+    CREATE TABLE Medias(IDMedia INTEGER PRIMARY KEY, DriveLetter INTEGER);
+    CREATE TABLE Folders(ID INTEGER PRIMARY KEY, IDMedia INTEGER);
+    CREATE TABLE Songs(ID INTEGER PRIMARY KEY, SongPath TEXT, IDFolder INTEGER, Artist TEXT, Album TEXT, AlbumArtist TEXT,
+                       Comment TEXT, Genre TEXT, Rating INTEGER, Year INTEGER, DiscNumber INTEGER, TrackNumber INTEGER,
+                       BPM INTEGER, SongTitle TEXT);
+    CREATE TABLE Playlists(IDPlaylist INTEGER PRIMARY KEY, PlaylistName TEXT);
+    CREATE TABLE PlaylistSongs(IDPlaylistSong INTEGER PRIMARY KEY, IDPlaylist INTEGER, IDSong INTEGER, SongOrder INTEGER);"""
+
+
+class FakeApi(object):
+    """Stands in for an authenticated gmusicapi.Api. Uploads take *upload_latency* seconds,
+    and every other call *call_latency* seconds; calls can overlap, like real requests."""
+
+    def __init__(self, upload_latency=0.0, call_latency=0.0):
+        self.upload_latency = upload_latency
+        self.call_latency = call_latency
+        self.calls = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _call(self, latency):
+        if latency:
+            time.sleep(latency)
+        with self._lock:
+            self.calls += 1
+            return next(self._ids)
+
+    def upload(self, path):
+        return {path: 'song-%s' % self._call(self.upload_latency)}
+
+    def change_song_metadata(self, songs):
+        self._call(self.call_latency)
+
+    def delete_songs(self, gm_ids):
+        self._call(self.call_latency)
+        return gm_ids
+
+    def create_playlist(self, name):
+        return 'playlist-%s' % self._call(self.call_latency)
+
+    def change_playlist_name(self, gm_id, name):
+        self._call(self.call_latency)
+
+    def delete_playlist(self, gm_id):
+        self._call(self.call_latency)
+
+    def change_playlist(self, gm_id, songs):
+        self._call(self.call_latency)
+
+    def add_songs_to_playlist(self, gm_id, song_ids):
+        self._call(self.call_latency)
+
+    def remove_songs_from_playlist(self, gm_id, song_ids):
+        self._call(self.call_latency)
+
+
+class Library(object):
+    """A MediaMonkey db and a service config dir under *root*, with sync2gm attached and its id tables created."""
+
+    def __init__(self, root):
+        self.root = root
+        self.db_fn = os.path.join(root, 'mm.db')
+        self.conf_dir = os.path.join(root, 'conf') + os.sep
+        os.makedirs(self.conf_dir)
+
+        #Song paths are a MediaMonkey drive letter plus the rest of the path. Off Windows, the 'drive'
+        #is a directory named like one in the working directory, so the paths still open.
+        drive, rest = os.path.splitdrive(os.path.join(os.path.abspath(root), 'songs'))
+        if drive:
+            self.drive_letter = ord(drive[0].upper()) - 65
+            self.songs_dir = drive + rest
+        else:
+            self.drive_letter = 0
+            os.chdir(root)
+            rest = os.sep + 'songs'
+            self.songs_dir = 'A:' + rest
+        self._song_path_prefix = rest
+        os.makedirs(self.songs_dir)
+
+        with closing(make_connection(self.db_fn)) as conn:
+            conn.executescript(schema_sql)
+            conn.execute("INSERT INTO Medias VALUES (1, ?)", (self.drive_letter,))
+            conn.execute("INSERT INTO Folders VALUES (1, 1)")
+            conn.commit()
+            service.reattach(conn, mm_config.action_pairs)
+
+        with closing(sqlite3.connect(self.conf_dir + service.id_db_fn)) as conn:
+            create_tables(conn)
+            conn.commit()
+
+    def connect(self):
+        return make_connection(self.db_fn)
+
+    def add_songs(self, conn, first_id, count, size=4096):
+        """Write *count* song files of *size* bytes, and add them to Songs from id *first_id* on.
+        When *size* is None, no files are written."""
+        for song_id in range(first_id, first_id + count):
+            fn = 's%d.mp3' % song_id
+            if size is not None:
+                with open(os.path.join(self.songs_dir, fn), 'wb') as f:
+                    f.write(os.urandom(size))
+
+            conn.execute("INSERT INTO Songs VALUES (?, ?, 1, 'artist', 'album', 'album artist', '', 'genre', 50, 2001, 1, ?, 0, 'title')",
+                         (song_id, ':' + os.path.join(self._song_path_prefix, fn), song_id))
+        conn.commit()
+
+    def poll_thread(self, api, **kwargs):
+        """Return a ChangePollThread (not yet started) for this library using *api*. *kwargs* are passed on to it."""
+        t = service.ChangePollThread(make_connection, api, self.db_fn, self.conf_dir, mm_config.action_pairs, **kwargs)
+
+        #keep the console quiet; everything still goes to the log file
+        for handler in t.log.handlers:
+            if not isinstance(handler, logging.FileHandler):
+                handler.setLevel(logging.WARNING)
+
+        return t
+
+def wait_until_idle(poll_thread, last_change_id, timeout=600):
+    """Block until *poll_thread* has handled every change through *last_change_id*. Return False on timeout."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        stats = poll_thread.stats()
+        if stats['last_change_id'] >= last_change_id and not stats['in_flight']:
+            return True
+        time.sleep(0.01)
+
+    return False
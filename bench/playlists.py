@@ -0,0 +1,94 @@
+"""Time to resolve and push a playlist change, for synthetic playlists of 10 to 10,000 entries.
+
+For each size, one playlist is filled with songs that are already mapped (a quarter of its entries are
+duplicates), and changePlaylistHandler reads and pushes it the way the service does:
+  rebuild - nothing was pushed before, so the whole playlist is resolved and replaced
+  cold    - the same, with the id cache emptied first, so every song id comes from the id database
+  edit    - one entry was appended since the last push, so only the delta is sent"""
+
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from contextlib import closing
+
+from fakes import FakeApi, Library
+
+from sync2gm import service
+from sync2gm.iddb import IdDatabase
+from sync2gm.mpconf import HandlerResult
+from sync2gm.mediamonkey import changePlaylistHandler
+
+
+def push(library, ids, api, log):
+    """Read and push playlist 1 like the service would, and return the seconds taken."""
+    start = time.time()
+
+    with closing(library.connect()) as conn:
+        with closing(conn.cursor()) as cur:
+            prefetched = changePlaylistHandler.prefetch([1], cur)
+
+    handler = changePlaylistHandler(1, api, None, ids.conn, lambda local_id, item_type, cur: ids.get_gm_id(local_id, item_type),
+                                    log, ids.get_gm_ids, ids)
+    handler.prefetched = prefetched.get(1)
+    handler.push_changes()
+
+    return time.time() - start
+
+def run(entries, repeat):
+    """Return a dict of the mean seconds per push of a playlist of *entries* entries, for each case."""
+    root = tempfile.mkdtemp(prefix='sync2gm-bench-')
+    try:
+        library = Library(root)
+        songs = max(1, entries * 3 // 4)
+
+        with closing(library.connect()) as conn:
+            library.add_songs(conn, 1, songs, size=None)
+            conn.execute("INSERT INTO Playlists VALUES (1, 'bench')")
+            conn.executemany("INSERT INTO PlaylistSongs VALUES (?, 1, ?, ?)",
+                             ((i, i % songs + 1, i) for i in range(1, entries + 1)))
+            conn.commit()
+
+        ids = IdDatabase(library.conf_dir + service.id_db_fn)
+        for song_id in range(1, songs + 1):
+            ids.update_mapping(song_id, HandlerResult(action='create', item_type='song', gm_id='song-%s' % song_id))
+        ids.update_mapping(1, HandlerResult(action='create', item_type='playlist', gm_id='playlist-1'))
+        ids.commit()
+
+        api = FakeApi()
+        log = logging.getLogger('sync2gm.bench')
+        times = {'rebuild': 0.0, 'cold': 0.0, 'edit': 0.0}
+
+        for i in range(repeat):
+            ids.forget_pushed('playlist', [1])
+            times['rebuild'] += push(library, ids, api, log)
+
+            ids.forget_pushed('playlist', [1])
+            ids.cache.clear()
+            times['cold'] += push(library, ids, api, log)
+
+            with closing(library.connect()) as conn:
+                conn.execute("INSERT INTO PlaylistSongs VALUES (?, 1, 1, ?)", (entries + i + 1, entries + i + 1))
+                conn.commit()
+            times['edit'] += push(library, ids, api, log)
+
+        ids.close()
+        return dict((case, total / repeat) for case, total in times.items())
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default=[10, 100, 1000, 10000], type=int, nargs='+', help='Playlist sizes to try. (default: %(default)s)')
+    parser.add_argument('--repeat', default=5, type=int, help='Pushes to average over, per case. (default: %(default)s)')
+    args = parser.parse_args()
+
+    print "%8s %12s %12s %12s" % ('entries', 'rebuild ms', 'cold ms', 'edit ms')
+    for entries in args.sizes:
+        times = run(entries, args.repeat)
+        print "%8d %12.2f %12.2f %12.2f" % (entries, times['rebuild'] * 1000, times['cold'] * 1000, times['edit'] * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Upload throughput of the service against a fake Api, for a range of upload worker pool sizes.
+
+Each run adds a batch of songs to a fresh synthetic library and times the service pushing all of them.
+Uploads sleep for --latency seconds, so the result shows how well the pool overlaps them;
+with no rate limiter, the ideal is workers / latency songs per second."""
+
+import time
+import shutil
+import argparse
+import tempfile
+from contextlib import closing
+
+from fakes import FakeApi, Library, wait_until_idle
+
+
+def run(songs, workers, latency, size):
+    """Return the seconds taken to push *songs* new songs of *size* bytes with *workers* upload workers."""
+    root = tempfile.mkdtemp(prefix='sync2gm-bench-')
+    try:
+        library = Library(root)
+        with closing(library.connect()) as conn:
+            library.add_songs(conn, 1, songs, size)
+            (last_change_id,) = conn.execute("SELECT max(changeId) FROM sync2gm_Changes").fetchone()
+
+        t = library.poll_thread(FakeApi(upload_latency=latency), upload_workers=workers, name='bench-%s' % workers)
+        start = time.time()
+        t.start()
+        finished = wait_until_idle(t, last_change_id)
+        elapsed = time.time() - start
+
+        t.stop()
+        t.join()
+        if not finished:
+            raise RuntimeError("timed out with %s workers" % workers)
+
+        return elapsed
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--songs', default=200, type=int, help='Songs to upload per run. (default: %(default)s)')
+    parser.add_argument('--workers', default=[1, 2, 4, 8, 16], type=int, nargs='+', help='Pool sizes to try. (default: %(default)s)')
+    parser.add_argument('--latency', default=0.1, type=float, help='Seconds each upload takes. (default: %(default)s)')
+    parser.add_argument('--size', default=64 * 1024, type=int, help='Bytes per song file. (default: %(default)s)')
+    args = parser.parse_args()
+
+    print "%d songs, %.3fs per upload" % (args.songs, args.latency)
+    print "%8s %10s %12s %10s" % ('workers', 'seconds', 'songs/s', 'of ideal')
+    for workers in args.workers:
+        elapsed = run(args.songs, workers, args.latency, args.size)
+        rate = args.songs / elapsed
+        ideal = workers / args.latency if args.latency else None
+        print "%8d %10.2f %12.1f %10s" % (workers, elapsed, rate, '%.0f%%' % (100 * rate / ideal) if ideal else '-')
+
+
+if __name__ == '__main__':
+    main()
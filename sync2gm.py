@@ -1,13 +1,17 @@
 import argparse
 import appdirs
 import os
+import time
+import json
 
 import sqlite3
 
 from sync2gm import service
 
 def setup(args):
-    print service.init_config(args.confname, args.mp_type, args.mp_db_path)
+    print service.init_config(args.confname, args.mp_type, args.mp_db_path, args.upload_workers,
+                              args.upload_max_mb << 20, int(args.upload_kbps * 1000 / 8) if args.upload_kbps else None,
+                              args.email)
 
 def run(args):
     ret = service.start_service(args.confname, args.port, args.email, args.password)
@@ -15,12 +19,80 @@ def run(args):
         print ret
 
 
+def serve(args):
+    ret = service.start_services(args.confnames, args.port, dict(args.account))
+    if ret is not True:
+        print ret
+
+def bootstrap(args):
+    ret = service.bootstrap_library(args.confname, args.email, args.password)
+    if ret is not True:
+        print ret
+
+def reconcile(args):
+    repairs = service.reconcile_library(args.confname, args.email, args.password, args.execute, args.delete_orphans)
+    if not isinstance(repairs, list):
+        print repairs
+        return
+
+    for action, item_type, local_id, gm_id, handler in repairs:
+        print "%s %s: local id %s, GM id %s%s" % (action, item_type, local_id, gm_id, " (%s)" % handler.__name__ if action == 'update' else '')
+
+    print len(repairs), "repairs", "pushed" if args.execute else "needed"
+
+def deadletters(args):
+    if args.replay is not None:
+        print service.replay_dead_letters(args.confname, args.replay or None), "changes queued for retry"
+        return
+
+    for dl_id, c_id, handler_name, local_id, attempts, failed_at, error in service.list_dead_letters(args.confname):
+        print "%s: change %s (%s, local id %s) failed %s times, last at %s: %s" % (
+            dl_id, c_id, handler_name, local_id, attempts, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(failed_at)), error)
+
 def stop(args): 
-    service.stop_service(args.port)
+    service.stop_service(args.port, args.library)
+
+def libraries(args):
+    for name in service.service_libraries(args.port):
+        print name
 
 def status(args):
     print service.is_service_running(args.port)
 
+def each_library(args, show):
+    #a service running several libraries is asked about each one in turn, unless one was picked
+    names = [args.library] if args.library is not None else service.service_libraries(args.port)
+    if len(names) <= 1:
+        show(args.library)
+        return
+
+    for name in names:
+        print "==", name
+        show(name)
+
+def limits(args):
+    each_library(args, lambda library: show_limits(args, library))
+
+def show_limits(args, library):
+    for name, lane in sorted(service.service_limits(args.port, library).items()):
+        print "%s: %s/s (max %s), %s in flight (max %s of %s), %s calls, %s errors, %s throttles" % (
+            name, lane['rate'], lane['max_rate'], lane['in_flight'], lane['concurrency'], lane['max_concurrency'],
+            lane['calls'], lane['errors'], lane['throttles'])
+        if 'bytes_in_flight' in lane:
+            print "%s: %s bytes in flight (max %s), at most %s bytes/s, %s bytes sent" % (
+                name, lane['bytes_in_flight'], lane['max_bytes'], lane['bandwidth'] or 'unlimited', lane['bytes'])
+
+def stats(args):
+    if args.prometheus:
+        #one scrape covers every library, labelled by name
+        print service.service_stats(args.port, prometheus=True, library=args.library),
+        return
+
+    print json.dumps(service.service_stats(args.port, library=args.library), indent=2, sort_keys=True)
+
+def profile(args):
+    print json.dumps(service.service_profile(args.port, args.rate, args.reset, args.cprofile, args.library), indent=2, sort_keys=True)
+
 def main():
     parser = argparse.ArgumentParser(description="Sync a local mediaplayer to Google Music.")
     subparsers = parser.add_subparsers(help='commands')
@@ -31,6 +103,10 @@ def main():
     parser_setup.add_argument('confname', help=confname_help)
     parser_setup.add_argument('mp_type', help='A supported mediaplayer type.') #should use choices here
     parser_setup.add_argument('mp_db_path', help='The path of the mediaplayer database file.')
+    parser_setup.add_argument('--upload-workers', default=4, type=int, help='The number of songs to upload at once. (default: %(default)s)')
+    parser_setup.add_argument('--upload-max-mb', default=256, type=int, help='The most megabytes of songs to upload at once. (default: %(default)s)')
+    parser_setup.add_argument('--upload-kbps', type=float, help='The most kilobits per second to upload, on average. (default: no limit)')
+    parser_setup.add_argument('--email', help='The Gmail address to sync to, when serving libraries for several accounts.')
     parser_setup.set_defaults(func=setup)
 
 
@@ -42,16 +118,74 @@ def main():
     parser_act.add_argument('--port', default=9000, type=int, help='The port to run on. (default: %(default)s)')
     parser_act.set_defaults(func=run)
 
+    parser_serve = subparsers.add_parser('serve', help='Run one service for several configurations.')
+
+    parser_serve.add_argument('confnames', nargs='*', metavar='confname', help='The configurations to run. (default: all of them)')
+    parser_serve.add_argument('--account', action='append', nargs=2, metavar=('EMAIL', 'PASSWORD'), required=True,
+                              help="An account to authenticate with. Give it once per account; with several, each configuration syncs to the one set up with its --email.")
+    parser_serve.add_argument('--port', default=9000, type=int, help='The port to run on. (default: %(default)s)')
+    parser_serve.set_defaults(func=serve)
+
+    parser_bootstrap = subparsers.add_parser('bootstrap', help='Push everything already in the library. Run this once after setup, before running the service.')
+
+    parser_bootstrap.add_argument('confname', help=confname_help)
+    parser_bootstrap.add_argument('email', help="Gmail address to authenticate with.")
+    parser_bootstrap.add_argument('password', help="Account password.")
+    parser_bootstrap.set_defaults(func=bootstrap)
+
+    parser_reconcile = subparsers.add_parser('reconcile', help='Compare the local library, the id mappings and Google Music, and list (or push) the fixes needed to bring them back in line.')
+
+    parser_reconcile.add_argument('confname', help=confname_help)
+    parser_reconcile.add_argument('email', help="Gmail address to authenticate with.")
+    parser_reconcile.add_argument('password', help="Account password.")
+    parser_reconcile.add_argument('--execute', action='store_true', help='Push the fixes, instead of only listing them. Stop the service first.')
+    parser_reconcile.add_argument('--delete-orphans', action='store_true', help='With --execute, also delete remote items that no local item maps to.')
+    parser_reconcile.set_defaults(func=reconcile)
+
+    parser_deadletters = subparsers.add_parser('deadletters', help='List changes that could not be pushed after several attempts, or queue them to be tried again.')
+
+    parser_deadletters.add_argument('confname', help=confname_help)
+    parser_deadletters.add_argument('--replay', nargs='*', type=int, metavar='ID', help='Queue these dead letters (default: all of them) to be pushed again.')
+    parser_deadletters.set_defaults(func=deadletters)
+
     parser_stop = subparsers.add_parser('stop', help='Stop a currently running service.')
 
     parser_stop.add_argument('--port', default=9000, type=int, help='The port the service is running on (default: %(default)s)')
+    parser_stop.add_argument('--library', help='Stop only this library of the service.')
     parser_stop.set_defaults(func=stop)
 
+    parser_libraries = subparsers.add_parser('libraries', help='List the libraries a running service is syncing.')
+
+    parser_libraries.add_argument('--port', default=9000, type=int, help='The port the service is running on (default: %(default)s)')
+    parser_libraries.set_defaults(func=libraries)
+
     parser_status = subparsers.add_parser('status', help='Display "True" if the service is running.')
 
     parser_status.add_argument('--port', default=9000, type=int, help='The port the service is running on (default: %(default)s)')
     parser_status.set_defaults(func=status)
 
+    parser_limits = subparsers.add_parser('limits', help='Display the current rate limits on Google Music calls of a running service.')
+
+    parser_limits.add_argument('--port', default=9000, type=int, help='The port the service is running on (default: %(default)s)')
+    parser_limits.add_argument('--library', help='The library to ask about, when the service runs several. (default: each of them)')
+    parser_limits.set_defaults(func=limits)
+
+    parser_stats = subparsers.add_parser('stats', help='Display the backlog, throughput and latency of a running service.')
+
+    parser_stats.add_argument('--port', default=9000, type=int, help='The port the service is running on (default: %(default)s)')
+    parser_stats.add_argument('--library', help='The library to ask about, when the service runs several. (default: all of them)')
+    parser_stats.add_argument('--prometheus', action='store_true', help='Print them in the Prometheus text format, eg for a textfile collector.')
+    parser_stats.set_defaults(func=stats)
+
+    parser_profile = subparsers.add_parser('profile', help='Display where a running service spends its time, for a sample of changes.')
+
+    parser_profile.add_argument('--port', default=9000, type=int, help='The port the service is running on (default: %(default)s)')
+    parser_profile.add_argument('--library', help='The library whose config directory gets the cProfile dumps. (default: the first)')
+    parser_profile.add_argument('--rate', type=float, help='The fraction of changes to time from now on; 0 turns timing off.')
+    parser_profile.add_argument('--reset', action='store_true', help='Forget the timings collected so far.')
+    parser_profile.add_argument('--cprofile', type=float, metavar='SECONDS', help='Run cProfile for this long, dumping the results to the config directory.')
+    parser_profile.set_defaults(func=profile)
+
 
 
     args = parser.parse_args()
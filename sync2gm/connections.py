@@ -0,0 +1,74 @@
+"""Long-lived sqlite connections for the service's threads."""
+
+import threading
+import sqlite3
+import contextlib
+
+
+class ConnectionManager(object):
+    """Hands out one long-lived sqlite connection per thread, and reconnects when one goes bad.
+
+    Connections are reused across polling passes, instead of opened for each pass or change."""
+
+    def __init__(self, connect):
+        """*connect* - a no-param func returning a new connection.
+        It needs to pass check_same_thread=False, so close_all can be called from any thread.
+        """
+
+        self._connect = connect
+        self._local = threading.local()
+        self._conns = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the calling thread's connection, connecting if needed."""
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._conns.append(conn)
+
+        return conn
+
+    def reset(self):
+        """Close the calling thread's connection, so the next get() reconnects."""
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is not None:
+            self._local.conn = None
+            with self._lock:
+                self._conns.remove(conn)
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Context manager for the calling thread's connection.
+
+        If an sqlite error escapes (eg the db is locked or the connection is stale),
+        the connection is reset before the error is reraised."""
+
+        try:
+            yield self.get()
+        except sqlite3.IntegrityError:
+            raise
+        except sqlite3.Error:
+            self.reset()
+            raise
+
+    def close_all(self):
+        """Close every connection handed out. Only call this once the threads using them are done."""
+        with self._lock:
+            conns, self._conns = self._conns, []
+
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+        self._local = threading.local()
@@ -0,0 +1,42 @@
+"""Content hashes of local files, so the service can recognise audio it has already uploaded."""
+
+import os
+import mmap
+import hashlib
+
+from profiling import profiler
+
+
+#bytes hashed at a time; files are never read into memory whole
+chunk_size = 1 << 20
+
+@profiler.timed('hash_file')
+def hash_file(path):
+    """Return a hex digest of the contents of the file at *path*, reading it through a memory map."""
+    digest = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+
+        if size: #empty files can't be mapped
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(0, size, chunk_size):
+                    digest.update(m[offset:offset + chunk_size])
+            finally:
+                m.close()
+
+    return digest.hexdigest()
+
+def cached_hash(path, id_db):
+    """Return the hash of the file at *path*, using the cache in IdDatabase *id_db*.
+
+    Files are only hashed again when their size or mtime changes."""
+    st = os.stat(path)
+
+    file_hash = id_db.get_file_hash(path, st.st_size, st.st_mtime)
+    if file_hash is None:
+        file_hash = hash_file(path)
+        id_db.set_file_hash(path, st.st_size, st.st_mtime, file_hash)
+
+    return file_hash
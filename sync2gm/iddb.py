@@ -0,0 +1,638 @@
+"""The service's own database, mapping local ids to Google Music ids."""
+
+import os
+import time
+import json
+import threading
+import sqlite3
+from collections import OrderedDict
+
+from mpconf import UnmappedId
+from profiling import profiler
+
+
+#Defines the tables in the id mapping database. Keys are HandlerResult.item_types.
+item_to_table = {'song': 'GMSongIds', 'playlist': 'GMPlaylistIds'}
+
+#Holds named counters for the service, like the id of the last change handled.
+state_table_sql = """
+    CREATE TABLE IF NOT EXISTS SyncState(
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL)"""
+
+#Hold the contents of each playlist as last pushed, so playlist changes can be sent as deltas.
+#A playlist without a row in PlaylistSnapshots has never been pushed as a whole.
+snapshot_tables_sql = """
+    CREATE TABLE IF NOT EXISTS PlaylistSnapshots(
+        localId INTEGER PRIMARY KEY);
+
+    CREATE TABLE IF NOT EXISTS PlaylistSnapshotEntries(
+        localEntryId INTEGER PRIMARY KEY,
+        localPlaylistId INTEGER NOT NULL,
+        gmSongId TEXT NOT NULL,
+        position INTEGER NOT NULL);
+
+    CREATE INDEX IF NOT EXISTS PlaylistSnapshotEntries_localPlaylistId
+        ON PlaylistSnapshotEntries(localPlaylistId, position);"""
+
+#FileHashes caches the content hash of local files, keyed by path, size and mtime.
+#SongHashes maps the content hash of each uploaded file to its GM song. A song deleted locally keeps its row
+# for a while, marked with deletedAt, so the same audio coming back (eg a moved file) can reuse it.
+hash_tables_sql = """
+    CREATE TABLE IF NOT EXISTS FileHashes(
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        hash TEXT NOT NULL);
+
+    CREATE TABLE IF NOT EXISTS SongHashes(
+        hash TEXT PRIMARY KEY,
+        gmId TEXT NOT NULL,
+        deletedAt REAL);
+
+    CREATE INDEX IF NOT EXISTS SongHashes_gmId ON SongHashes(gmId);"""
+
+#Holds the metadata last pushed for each song, as a json-encoded GM song dict (without an id).
+metadata_table_sql = """
+    CREATE TABLE IF NOT EXISTS SongMetadata(
+        localId INTEGER PRIMARY KEY,
+        metadata TEXT NOT NULL)"""
+
+#RetryQueue holds changes that failed to push, to be tried again at nextAttempt. There's at most one row per
+# changeType and localId, since pushing the same change twice brings the item up to date either way.
+#DeadLetters holds changes that failed too many times. They stay there until replayed from the command line.
+retry_tables_sql = """
+    CREATE TABLE IF NOT EXISTS RetryQueue(
+        changeType INTEGER NOT NULL,
+        localId INTEGER NOT NULL,
+        changeId INTEGER NOT NULL,
+        attempts INTEGER NOT NULL,
+        nextAttempt REAL NOT NULL,
+        lastError TEXT,
+        PRIMARY KEY (changeType, localId));
+
+    CREATE INDEX IF NOT EXISTS RetryQueue_nextAttempt ON RetryQueue(nextAttempt);
+
+    CREATE TABLE IF NOT EXISTS DeadLetters(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        changeType INTEGER NOT NULL,
+        localId INTEGER NOT NULL,
+        changeId INTEGER NOT NULL,
+        attempts INTEGER NOT NULL,
+        failedAt REAL NOT NULL,
+        lastError TEXT);"""
+
+#Indexes the files transcoded ahead of upload (see prepare.Preparer), keyed by the path, size and mtime of the source.
+#Files are named by the hash of their contents, so sources with the same result share one.
+prepared_table_sql = """
+    CREATE TABLE IF NOT EXISTS PreparedFiles(
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        hash TEXT NOT NULL,
+        bytes INTEGER NOT NULL,
+        lastUsed REAL NOT NULL);
+
+    CREATE INDEX IF NOT EXISTS PreparedFiles_hash ON PreparedFiles(hash);"""
+
+def create_tables(conn):
+    """(Re)create the id database tables using *conn*. Any existing mappings are dropped."""
+
+    for table in item_to_table.values():
+        conn.executescript("""
+            DROP TABLE IF EXISTS {tablename};
+
+            CREATE TABLE {tablename}(
+                localId INTEGER PRIMARY KEY,
+                gmId TEXT NOT NULL);
+            """.format(tablename=table))
+
+    conn.execute("DROP TABLE IF EXISTS PlaylistSnapshots")
+    conn.execute("DROP TABLE IF EXISTS PlaylistSnapshotEntries")
+    conn.executescript(snapshot_tables_sql)
+
+    conn.execute("DROP TABLE IF EXISTS FileHashes")
+    conn.execute("DROP TABLE IF EXISTS SongHashes")
+    conn.executescript(hash_tables_sql)
+
+    conn.execute("DROP TABLE IF EXISTS SongMetadata")
+    conn.execute(metadata_table_sql)
+
+    conn.execute("DROP TABLE IF EXISTS RetryQueue")
+    conn.execute("DROP TABLE IF EXISTS DeadLetters")
+    conn.executescript(retry_tables_sql)
+
+    conn.execute("DROP TABLE IF EXISTS PreparedFiles")
+    conn.executescript(prepared_table_sql)
+
+    conn.execute("DROP TABLE IF EXISTS SyncState")
+    conn.execute(state_table_sql)
+    with conn:
+        conn.execute("INSERT INTO SyncState (name, value) VALUES ('last_change', 0)")
+
+
+class LRUCache(object):
+    """A dict-like cache holding at most *size* items, dropping the least recently used first."""
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """Return the value for *key*, marking it recently used, or *default* if it's not cached."""
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._items[key] = value
+        return value
+
+    def put(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+    def discard(self, key):
+        self._items.pop(key, None)
+
+    def clear(self):
+        self._items.clear()
+
+#Marks an item we know has no mapping in the cache.
+_unmapped = object()
+
+#sqlite limits the number of host parameters in a query
+max_params = 500
+
+def _select_in(cur, sql, ids):
+    """Return the rows of *sql* for all of *ids*, which fill in its '%s' as a list of parameters.
+    Large lists are split over several queries."""
+
+    ids = list(ids)
+    rows = []
+    for i in range(0, len(ids), max_params):
+        chunk = ids[i:i + max_params]
+        rows.extend(cur.execute(sql % ','.join('?' * len(chunk)), chunk).fetchall())
+
+    return rows
+
+class IdDatabase(object):
+    """Holds the connection to the id database, which is shared by every thread of the service.
+
+    Writes are group-committed: they stay in an open transaction until commit() is called,
+    which the service does along with advancing its checkpoint. Every thread writes to that one
+    transaction, so a failed commit is retried later rather than rolled back: rolling back would
+    lose the mappings of pushes that succeeded.
+
+    Lookups go through a write-through cache of (item_type, localId) -> gmId. Nothing but
+    update_mapping writes mappings while the service runs, so it stays coherent."""
+
+    def __init__(self, db_fn, cache_size=50000):
+        self._db = db_fn
+        self._conn = None
+        self._lock = threading.RLock()
+        self.cache = LRUCache(cache_size)
+        self._expiring = set() #GM ids of songs being deleted remotely, which mustn't be claimed
+
+    @property
+    def conn(self):
+        """The shared connection. From more than one thread, use it through the methods here, which hold the lock."""
+        with self._lock:
+            if self._conn is None:
+                self._conn = sqlite3.connect(self._db, check_same_thread=False)
+
+            return self._conn
+
+    def reset(self):
+        """Roll back anything uncommitted and close the connection, so the next use reconnects.
+
+        This throws away the mappings of any pushes since the last commit, so only use it when closing."""
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.rollback()
+                    self._conn.close()
+                except sqlite3.Error:
+                    pass
+                self._conn = None
+
+            #uncommitted mappings were just rolled back
+            self.cache.clear()
+
+    close = reset
+
+    def upgrade(self, legacy_change_fn):
+        """Add any tables missing from an id database created by an older version.
+
+        The checkpoint is seeded from *legacy_change_fn*, the file it used to be kept in, if that exists."""
+        with self._lock:
+            self.conn.execute(state_table_sql)
+            self.conn.executescript(snapshot_tables_sql)
+            self.conn.executescript(hash_tables_sql)
+            self.conn.execute(metadata_table_sql)
+            self.conn.executescript(retry_tables_sql)
+            self.conn.executescript(prepared_table_sql)
+
+            if self.get_state('last_change') is None:
+                last_change = 0
+                if os.path.isfile(legacy_change_fn):
+                    with open(legacy_change_fn) as f:
+                        last_change = int(f.readline().strip())
+
+                self.commit_checkpoint(last_change)
+
+    def warm(self):
+        """Fill the cache from the mapping tables, up to its size."""
+        with self._lock:
+            for item_type, table in item_to_table.items():
+                for local_id, gm_id in self.conn.execute("SELECT localId, gmId FROM %s LIMIT ?" % table, (self.cache.size - len(self.cache),)):
+                    self.cache.put((item_type, local_id), gm_id)
+
+    def get_gm_id(self, local_id, item_type):
+        """Return the GM id for this *local_id* and *item_type*, or raise UnmappedId."""
+        with self._lock:
+            gm_id = self.cache.get((item_type, local_id))
+
+            if gm_id is None:
+                row = self.conn.execute("SELECT gmId FROM %s WHERE localId=?" % item_to_table[item_type], (local_id,)).fetchone()
+                gm_id = row[0] if row else _unmapped
+                self.cache.put((item_type, local_id), gm_id)
+
+        if gm_id is _unmapped: raise UnmappedId
+
+        return gm_id
+
+    def get_gm_ids(self, local_ids, item_type):
+        """Return a dict mapping each of *local_ids* that has a mapping for *item_type* to its GM id.
+
+        Anything not in the cache is looked up in as few queries as possible."""
+
+        gm_ids = {}
+        with self._lock:
+            misses = []
+            for local_id in set(local_ids):
+                gm_id = self.cache.get((item_type, local_id))
+                if gm_id is None:
+                    misses.append(local_id)
+                elif gm_id is not _unmapped:
+                    gm_ids[local_id] = gm_id
+
+            found = dict(_select_in(self.conn, "SELECT localId, gmId FROM %s WHERE localId IN (%%s)" % item_to_table[item_type], misses))
+
+            for local_id in misses:
+                self.cache.put((item_type, local_id), found.get(local_id, _unmapped))
+            gm_ids.update(found)
+
+        return gm_ids
+
+    def get_mappings(self, item_type, after=None, limit=5000):
+        """Return at most *limit* (localId, gmId) mappings for *item_type* with local ids after *after* (or from the start), in order."""
+        with self._lock:
+            if after is None:
+                return self.conn.execute("SELECT localId, gmId FROM %s ORDER BY localId LIMIT ?" % item_to_table[item_type], (limit,)).fetchall()
+
+            return self.conn.execute("SELECT localId, gmId FROM %s WHERE localId > ? ORDER BY localId LIMIT ?" % item_to_table[item_type],
+                                     (after, limit)).fetchall()
+
+    def update_mapping(self, local_id, handler_res):
+        """Update the local to remote id mapping with a HandlerResult (*handler_res*). This isn't committed."""
+        action, item_type, gm_id = handler_res
+
+        #two switches for the different events; they're too dissimilar to factor out
+        if action == 'create':
+            command = "REPLACE INTO {table} (localId, gmId) VALUES (?, ?)"
+            values = (local_id, gm_id)
+        elif action == 'delete':
+            command = "DELETE FROM {table} WHERE localId=?"
+            values = (local_id,)
+        else:
+            raise Exception("Unknown HandlerResult.action")
+
+        command = command.format(table=item_to_table[item_type])
+
+        with self._lock:
+            self.conn.execute(command, values)
+            self.cache.put((item_type, local_id), gm_id if action == 'create' else _unmapped)
+
+            #a new item hasn't had metadata pushed, and a new playlist starts out empty;
+            # a deleted item has nothing left to diff against
+            if item_type == 'song':
+                self.conn.execute("DELETE FROM SongMetadata WHERE localId=?", (local_id,))
+
+            if item_type == 'playlist':
+                self._drop_playlist_snapshot(local_id)
+                if action == 'create':
+                    self.set_playlist_snapshot(local_id, [])
+
+    def forget_pushed(self, item_type, local_ids):
+        """Forget what was last pushed for *local_ids*, so their next update is pushed in full. This isn't committed."""
+        with self._lock:
+            for local_id in local_ids:
+                if item_type == 'song':
+                    self.conn.execute("DELETE FROM SongMetadata WHERE localId=?", (local_id,))
+                elif item_type == 'playlist':
+                    self._drop_playlist_snapshot(local_id)
+
+    def get_song_metadata(self, local_ids):
+        """Return a dict mapping each of *local_ids* to the GM metadata dict last pushed for it, if any."""
+        with self._lock:
+            rows = _select_in(self.conn, "SELECT localId, metadata FROM SongMetadata WHERE localId IN (%s)", local_ids)
+
+        return dict((local_id, json.loads(md)) for local_id, md in rows)
+
+    def set_song_metadata(self, metadata):
+        """Record *metadata*, a dict of localId -> GM metadata dict, as pushed. This isn't committed."""
+        with self._lock:
+            self.conn.executemany("REPLACE INTO SongMetadata (localId, metadata) VALUES (?, ?)",
+                                  ((local_id, json.dumps(md, sort_keys=True, separators=(',', ':'))) for local_id, md in metadata.items()))
+
+    def get_playlist_snapshot(self, local_id):
+        """Return the playlist *local_id* as last pushed, as an ordered list of (localEntryId, gmSongId),
+        or None if it never was."""
+        with self._lock:
+            if self.conn.execute("SELECT 1 FROM PlaylistSnapshots WHERE localId=?", (local_id,)).fetchone() is None:
+                return None
+
+            return self.conn.execute("SELECT localEntryId, gmSongId FROM PlaylistSnapshotEntries WHERE localPlaylistId=? ORDER BY position",
+                                     (local_id,)).fetchall()
+
+    def _drop_playlist_snapshot(self, local_id):
+        self.conn.execute("DELETE FROM PlaylistSnapshots WHERE localId=?", (local_id,))
+        self.conn.execute("DELETE FROM PlaylistSnapshotEntries WHERE localPlaylistId=?", (local_id,))
+
+    def set_playlist_snapshot(self, local_id, entries):
+        """Record the playlist *local_id* as pushed with *entries*, an ordered list of (localEntryId, gmSongId).
+        This isn't committed."""
+        with self._lock:
+            self._drop_playlist_snapshot(local_id)
+            self.conn.execute("INSERT INTO PlaylistSnapshots (localId) VALUES (?)", (local_id,))
+            self.conn.executemany("INSERT INTO PlaylistSnapshotEntries (localEntryId, localPlaylistId, gmSongId, position) VALUES (?, ?, ?, ?)",
+                                  ((entry_id, local_id, gm_song_id, pos) for pos, (entry_id, gm_song_id) in enumerate(entries)))
+
+    def playlists_with_songs(self, gm_song_ids):
+        """Return the local ids of the playlists whose snapshots contain any of *gm_song_ids*."""
+        with self._lock:
+            rows = _select_in(self.conn, "SELECT DISTINCT localPlaylistId FROM PlaylistSnapshotEntries WHERE gmSongId IN (%s)", gm_song_ids)
+
+        return sorted(set(row[0] for row in rows))
+
+    def update_playlist_snapshot(self, local_id, removed_entry_ids, added_entries):
+        """Remove *removed_entry_ids* from the snapshot of playlist *local_id*, then append *added_entries*,
+        a list of (localEntryId, gmSongId). This isn't committed."""
+        with self._lock:
+            self.conn.executemany("DELETE FROM PlaylistSnapshotEntries WHERE localEntryId=?", ((entry_id,) for entry_id in removed_entry_ids))
+
+            (last_pos,) = self.conn.execute("SELECT coalesce(max(position), -1) FROM PlaylistSnapshotEntries WHERE localPlaylistId=?", (local_id,)).fetchone()
+            self.conn.executemany("INSERT INTO PlaylistSnapshotEntries (localEntryId, localPlaylistId, gmSongId, position) VALUES (?, ?, ?, ?)",
+                                  ((entry_id, local_id, gm_song_id, last_pos + 1 + i) for i, (entry_id, gm_song_id) in enumerate(added_entries)))
+
+    def get_file_hash(self, path, size, mtime):
+        """Return the cached hash of the file at *path*, or None if it's not cached for this *size* and *mtime*."""
+        with self._lock:
+            row = self.conn.execute("SELECT hash FROM FileHashes WHERE path=? AND size=? AND mtime=?", (path, size, mtime)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def set_file_hash(self, path, size, mtime, file_hash):
+        """Cache the hash of the file at *path*. This isn't committed."""
+        with self._lock:
+            self.conn.execute("REPLACE INTO FileHashes (path, size, mtime, hash) VALUES (?, ?, ?, ?)", (path, size, mtime, file_hash))
+
+    def get_prepared(self, path, size, mtime):
+        """Return the hash of the prepared copy of the file at *path*, marking it used, or None if there isn't one
+        for this *size* and *mtime*. This isn't committed."""
+        with self._lock:
+            row = self.conn.execute("SELECT hash FROM PreparedFiles WHERE path=? AND size=? AND mtime=?", (path, size, mtime)).fetchone()
+            if row is not None:
+                self.conn.execute("UPDATE PreparedFiles SET lastUsed=? WHERE path=?", (time.time(), path))
+
+        return row[0] if row is not None else None
+
+    def add_prepared(self, path, size, mtime, file_hash, num_bytes):
+        """Record that the file at *path* was prepared into a file of *num_bytes* with *file_hash*. This isn't committed."""
+        with self._lock:
+            self.conn.execute("REPLACE INTO PreparedFiles (path, size, mtime, hash, bytes, lastUsed) VALUES (?, ?, ?, ?, ?, ?)",
+                              (path, size, mtime, file_hash, num_bytes, time.time()))
+
+    def prepared_hashes(self):
+        """Return the set of hashes of every prepared file."""
+        with self._lock:
+            return set(row[0] for row in self.conn.execute("SELECT DISTINCT hash FROM PreparedFiles"))
+
+    def prepared_to_evict(self, max_bytes, keep=()):
+        """Return the hashes of the least recently used prepared files to drop so the rest fit in *max_bytes*,
+        never including those in *keep*."""
+        with self._lock:
+            files = self.conn.execute("SELECT hash, max(bytes), max(lastUsed) FROM PreparedFiles GROUP BY hash ORDER BY max(lastUsed)").fetchall()
+
+        total = sum(num_bytes for file_hash, num_bytes, last_used in files)
+        evict = []
+        for file_hash, num_bytes, last_used in files:
+            if total <= max_bytes:
+                break
+            if file_hash not in keep:
+                evict.append(file_hash)
+                total -= num_bytes
+
+        return evict
+
+    def drop_prepared(self, file_hash):
+        """Forget the prepared file with *file_hash*. This isn't committed."""
+        with self._lock:
+            self.conn.execute("DELETE FROM PreparedFiles WHERE hash=?", (file_hash,))
+
+    def add_song_hash(self, file_hash, gm_id):
+        """Record that GM song *gm_id* was uploaded from a file with *file_hash*. This isn't committed."""
+        with self._lock:
+            self.conn.execute("REPLACE INTO SongHashes (hash, gmId, deletedAt) VALUES (?, ?, NULL)", (file_hash, gm_id))
+
+    def has_song_hash(self, file_hash):
+        """Return True if a song was uploaded from a file with *file_hash* (and could be claimed)."""
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM SongHashes WHERE hash=?", (file_hash,)).fetchone() is not None
+
+    def claim_song_hash(self, file_hash):
+        """Return the GM id of a song uploaded from a file with *file_hash*, or None.
+
+        A song deleted locally but not yet remotely is revived. This isn't committed."""
+        with self._lock:
+            row = self.conn.execute("SELECT gmId, deletedAt FROM SongHashes WHERE hash=?", (file_hash,)).fetchone()
+            if row is None or row[0] in self._expiring:
+                return None
+
+            gm_id, deleted_at = row
+            if deleted_at is not None:
+                self.conn.execute("UPDATE SongHashes SET deletedAt=NULL WHERE hash=?", (file_hash,))
+
+        return gm_id
+
+    def song_refcount(self, gm_id):
+        """Return the number of local songs mapped to GM song *gm_id*."""
+        with self._lock:
+            return self.conn.execute("SELECT count(*) FROM GMSongIds WHERE gmId=?", (gm_id,)).fetchone()[0]
+
+    def tombstone_song(self, gm_id):
+        """Mark GM song *gm_id* as deleted locally, and return True, if its hash is known. This isn't committed.
+
+        The service deletes it remotely once it's been dead for a while, unless its audio is added again."""
+        with self._lock:
+            return self.conn.execute("UPDATE SongHashes SET deletedAt=? WHERE gmId=? AND deletedAt IS NULL", (time.time(), gm_id)).rowcount > 0
+
+    def take_expired_songs(self, grace):
+        """Return the GM ids of songs tombstoned more than *grace* seconds ago, to be deleted remotely.
+
+        They can't be claimed until release_expired_songs is called with them, so a copy added again
+        in the meantime is uploaded instead of being mapped to a song that's about to go."""
+        with self._lock:
+            gm_ids = [row[0] for row in self.conn.execute("SELECT gmId FROM SongHashes WHERE deletedAt < ?", (time.time() - grace,))]
+            self._expiring.update(gm_ids)
+
+        return gm_ids
+
+    def release_expired_songs(self, gm_ids):
+        """Let songs taken with take_expired_songs be claimed again, eg once their hashes are dropped."""
+        with self._lock:
+            self._expiring.difference_update(gm_ids)
+
+    def tracked_song_ids(self):
+        """Return the set of GM song ids with a known hash, including those deleted locally but kept remotely for now."""
+        with self._lock:
+            return set(row[0] for row in self.conn.execute("SELECT gmId FROM SongHashes"))
+
+    def drop_song_hashes(self, gm_ids):
+        """Forget the hashes of GM songs *gm_ids*, eg once they're deleted remotely. This isn't committed."""
+        with self._lock:
+            self.conn.executemany("DELETE FROM SongHashes WHERE gmId=?", ((gm_id,) for gm_id in gm_ids))
+
+    def retry_attempts(self, change):
+        """Return the number of times *change*, a (changeId, changeType, localId), has already failed."""
+        c_id, c_type, local_id = change
+        with self._lock:
+            row = self.conn.execute("SELECT attempts FROM RetryQueue WHERE changeType=? AND localId=?", (c_type, local_id)).fetchone()
+
+        return row[0] if row is not None else 0
+
+    def schedule_retry(self, change, attempts, next_attempt, error):
+        """Queue *change* to be pushed again at time *next_attempt*, having failed *attempts* times with *error*. This isn't committed."""
+        c_id, c_type, local_id = change
+        with self._lock:
+            #keep the id of the change that first failed
+            if not self.conn.execute("UPDATE RetryQueue SET attempts=?, nextAttempt=?, lastError=? WHERE changeType=? AND localId=?",
+                                     (attempts, next_attempt, error, c_type, local_id)).rowcount:
+                self.conn.execute("INSERT INTO RetryQueue (changeType, localId, changeId, attempts, nextAttempt, lastError) VALUES (?, ?, ?, ?, ?, ?)",
+                                  (c_type, local_id, c_id, attempts, next_attempt, error))
+
+    def clear_retries(self, changes):
+        """Drop any queued retries for *changes*, eg once they're pushed. This isn't committed."""
+        with self._lock:
+            self.conn.executemany("DELETE FROM RetryQueue WHERE changeType=? AND localId=?",
+                                  ((c_type, local_id) for c_id, c_type, local_id in changes))
+
+    def take_due_retries(self, limit, lease):
+        """Return at most *limit* queued changes that are due, as (changeId, changeType, localId).
+
+        They're pushed back *lease* seconds, so they aren't taken again while being pushed; they
+        come back by themselves if the service dies before finishing them. This isn't committed."""
+        now = time.time()
+        with self._lock:
+            changes = self.conn.execute("SELECT changeId, changeType, localId FROM RetryQueue WHERE nextAttempt <= ? ORDER BY nextAttempt LIMIT ?",
+                                        (now, limit)).fetchall()
+            self.conn.executemany("UPDATE RetryQueue SET nextAttempt=? WHERE changeType=? AND localId=?",
+                                  ((now + lease, c_type, local_id) for c_id, c_type, local_id in changes))
+
+        return changes
+
+    def release_retries(self, changes, next_attempt):
+        """Put *changes* taken with take_due_retries back in the queue, due at *next_attempt*. This isn't committed."""
+        with self._lock:
+            self.conn.executemany("UPDATE RetryQueue SET nextAttempt=? WHERE changeType=? AND localId=?",
+                                  ((next_attempt, c_type, local_id) for c_id, c_type, local_id in changes))
+
+    def next_retry_at(self):
+        """Return the time the next queued retry is due, or None if there are none."""
+        with self._lock:
+            return self.conn.execute("SELECT min(nextAttempt) FROM RetryQueue").fetchone()[0]
+
+    def dead_letter(self, change, attempts, error):
+        """Give up on *change* after *attempts* failures, moving it to DeadLetters. This isn't committed."""
+        c_id, c_type, local_id = change
+        with self._lock:
+            row = self.conn.execute("SELECT changeId FROM RetryQueue WHERE changeType=? AND localId=?", (c_type, local_id)).fetchone()
+            if row is not None:
+                c_id = row[0]
+                self.conn.execute("DELETE FROM RetryQueue WHERE changeType=? AND localId=?", (c_type, local_id))
+
+            self.conn.execute("INSERT INTO DeadLetters (changeType, localId, changeId, attempts, failedAt, lastError) VALUES (?, ?, ?, ?, ?, ?)",
+                              (c_type, local_id, c_id, attempts, time.time(), error))
+
+    def get_dead_letters(self):
+        """Return every dead letter, oldest first, as (id, changeId, changeType, localId, attempts, failedAt, lastError)."""
+        with self._lock:
+            return self.conn.execute("SELECT id, changeId, changeType, localId, attempts, failedAt, lastError FROM DeadLetters ORDER BY id").fetchall()
+
+    def replay_dead_letters(self, dl_ids=None):
+        """Move the dead letters with ids *dl_ids* (or all of them) back to the retry queue, due now, and return how many moved.
+
+        This isn't committed."""
+        with self._lock:
+            if dl_ids is None:
+                dl_ids = [row[0] for row in self.conn.execute("SELECT id FROM DeadLetters")]
+
+            moved = 0
+            for dl_id in dl_ids:
+                row = self.conn.execute("SELECT changeId, changeType, localId, lastError FROM DeadLetters WHERE id=?", (dl_id,)).fetchone()
+                if row is None:
+                    continue
+
+                c_id, c_type, local_id, error = row
+                self.schedule_retry((c_id, c_type, local_id), 0, time.time(), error)
+                self.conn.execute("DELETE FROM DeadLetters WHERE id=?", (dl_id,))
+                moved += 1
+
+        return moved
+
+    def get_state(self, name, default=None):
+        """Return the SyncState value for *name*, or *default* if there is none."""
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM SyncState WHERE name=?", (name,)).fetchone()
+
+        return row[0] if row is not None else default
+
+    def set_state(self, name, value):
+        """Set the SyncState value for *name*. This isn't committed."""
+        with self._lock:
+            self.conn.execute("REPLACE INTO SyncState (name, value) VALUES (?, ?)", (name, value))
+
+    def del_state(self, name):
+        """Remove the SyncState value for *name*. This isn't committed."""
+        with self._lock:
+            self.conn.execute("DELETE FROM SyncState WHERE name=?", (name,))
+
+    def commit(self):
+        """Commit any pending writes."""
+        with self._lock:
+            self.conn.commit()
+
+    def get_checkpoint(self):
+        """Return the id of the last change handled."""
+        return self.get_state('last_change', 0)
+
+    @profiler.timed('commit_checkpoint')
+    def commit_checkpoint(self, change_id):
+        """Record *change_id* as the last change handled, and commit it along with any other pending writes."""
+        with self._lock:
+            self.set_state('last_change', change_id)
+            self.conn.commit()
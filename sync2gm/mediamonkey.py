@@ -1,13 +1,19 @@
 """Define a service configuration for MediaMonkey."""
 
 import sqlite3
+import json
+import threading
+import time
 from contextlib import closing
 from collections import namedtuple
 
-from mpconf import MPConf, ActionPair, TriggerDef, HandlerResult, Handler, GMSyncError, LocalOutdated
+from mpconf import MPConf, ActionPair, TriggerDef, BootstrapDef, HandlerResult, Handler, GMSyncError, LocalOutdated
 
 from gmusicapi import CallFailure
 
+from hashing import cached_hash
+from profiling import profiler
+
 
 #A service implements various structures and functions so that a service 
 # knows how to handle changes.
@@ -81,135 +87,411 @@ for mdm in md_mappings:
 mm_sql_cols = repr(tuple(col_to_mdm.keys())).replace("'","")[1:-1]
 
 
-def get_path(local_id, cur):
-    """Return the full file path of this item, or raise GMSyncError. Only works for local items (eg not with media servers)."""
+def to_gm_song(mm_md):
+    """Return a GM song dictionary (without an id) holding the mapped metadata in a Songs row, *mm_md*."""
 
-    path_data = cur.execute("SELECT SongPath, IDFolder from Songs WHERE ID=?", (local_id,)).fetchone()
+    gm_song = {}
+    for col, mdm in col_to_mdm.items():
+        gm_song[mdm.gm_key] = mdm.to_gm_form(mm_md[col])
 
-    if path_data is None:
-        raise LocalOutdated
+    return gm_song
 
-    path, f_id = path_data
 
-    #MM separates the path and media, so we need to get the drive letter separately.
-    (d_letter,) = cur.execute("SELECT DriveLetter FROM Medias WHERE IDMedia=(SELECT IDMedia FROM Folders WHERE ID=?)", (f_id,)).fetchone()
-    if path is not None and d_letter is not None:
-        #d_letter is an int that needs to be coerced into the right char.
-        #MM docs are inspecific, so we always coerce into ascii cap letter range.
-        if d_letter < 26: d_letter = chr(d_letter + 65) #assumed given a 0-25 ord
-        elif d_letter > 90: d_letter = chr(d_letter - 32) #assumed given a lowercase ascii
-        else: raise GMSyncError("Could not coerce mediamonkey drive letter to a character. Given: " + repr(d_letter) + " for local_id: " + repr(local_id))
+#sqlite limits the number of host parameters in a query
+max_params = 500
 
-        return d_letter + path
-    else:
-        raise GMSyncError("Drive letter or path null for local_id: " + repr(local_id))
+def select_in(cur, sql, ids):
+    """Return the rows of *sql* for all of *ids*, which fill in its '%s' as a list of parameters.
+    Large lists are split over several queries."""
+
+    ids = list(ids)
+    rows = []
+    for i in range(0, len(ids), max_params):
+        chunk = ids[i:i + max_params]
+        rows.extend(cur.execute(sql % ','.join('?' * len(chunk)), chunk).fetchall())
+
+    return rows
+
+def to_drive_letter(d_letter, local_id):
+    """Return the drive letter for a MM DriveLetter, *d_letter*, or raise GMSyncError."""
+
+    #d_letter is an int that needs to be coerced into the right char.
+    #MM docs are inspecific, so we always coerce into ascii cap letter range.
+    if d_letter < 26: return chr(d_letter + 65) #assumed given a 0-25 ord
+    elif d_letter > 90: return chr(d_letter - 32) #assumed given a lowercase ascii
+    else: raise GMSyncError("Could not coerce mediamonkey drive letter to a character. Given: " + repr(d_letter) + " for local_id: " + repr(local_id))
+
+class PathResolver(object):
+    """Resolves song ids to full file paths for one MM database.
+
+    Folders and Medias are small, so they're held in memory as a map of folder id -> drive letter,
+    and a batch of songs only needs one query against Songs. The map is reloaded when a song's folder
+    isn't in it, or when a cheap checksum of those tables changes (checked at most every recheck_interval seconds)."""
+
+    recheck_interval = 5
+
+    def __init__(self):
+        self._drives = None #folder id -> DriveLetter
+        self._checksum = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def _get_checksum(self, cur):
+        return tuple(cur.execute("""SELECT (SELECT count(*) || ':' || total(ID * 31 + IDMedia) FROM Folders),
+                                     (SELECT count(*) || ':' || total(IDMedia * 31 + DriveLetter) FROM Medias)""").fetchone())
+
+    def _load(self, cur):
+        self._checksum = self._get_checksum(cur)
+        self._checked = time.time()
+        self._drives = dict(cur.execute("SELECT Folders.ID, Medias.DriveLetter FROM Folders JOIN Medias ON Medias.IDMedia = Folders.IDMedia"))
+
+    def _refresh(self, cur):
+        """Reload the map if it's never been loaded or the tables changed."""
+        if self._drives is None:
+            self._load(cur)
+        elif time.time() - self._checked >= self.recheck_interval:
+            self._checked = time.time()
+            if self._get_checksum(cur) != self._checksum:
+                self._load(cur)
+
+    def resolve(self, local_ids, cur):
+        """Return a dict mapping each of *local_ids* that's still in Songs to its full path,
+        or to the GMSyncError raised when resolving it."""
+
+        rows = select_in(cur, "SELECT ID, SongPath, IDFolder FROM Songs WHERE ID IN (%s)", local_ids)
+
+        with self._lock:
+            self._refresh(cur)
+            if any(f_id not in self._drives for local_id, path, f_id in rows):
+                self._load(cur) #a new folder
+            drives = self._drives
+
+        paths = {}
+        for local_id, path, f_id in rows:
+            d_letter = drives.get(f_id)
+
+            if path is not None and d_letter is not None:
+                try:
+                    paths[local_id] = to_drive_letter(d_letter, local_id) + path
+                except GMSyncError as e:
+                    paths[local_id] = e
+            else:
+                paths[local_id] = GMSyncError("Drive letter or path null for local_id: " + repr(local_id))
+
+        return paths
 
+#One PathResolver per MM database file.
+_resolvers = {}
+_resolvers_lock = threading.Lock()
+
+def get_resolver(cur):
+    """Return the PathResolver for the database *cur* is connected to."""
+    db_fn = [row[2] for row in cur.execute("PRAGMA database_list") if row[1] == 'main'][0]
+
+    with _resolvers_lock:
+        if db_fn not in _resolvers:
+            _resolvers[db_fn] = PathResolver()
+        return _resolvers[db_fn]
+
+@profiler.timed('get_path')
+def get_paths(local_ids, cur):
+    """Return a dict mapping each of *local_ids* still in Songs to its full file path, in one query,
+    or to the GMSyncError raised when resolving it. Only works for local items (eg not with media servers)."""
+
+    return get_resolver(cur).resolve(local_ids, cur)
+
+def get_playlist_names(local_ids, cur):
+    """Return a dict mapping each of *local_ids* still in Playlists to its name."""
+    return dict(select_in(cur, "SELECT IDPlaylist, PlaylistName FROM Playlists WHERE IDPlaylist IN (%s)", local_ids))
 
 
 class cSongHandler(Handler):
+    item_type = 'song'
+    action = 'create'
+    parallel = True
+
+    @classmethod
+    def prefetch(cls, local_ids, mp_cur):
+        return get_paths(local_ids, mp_cur)
+
+    @classmethod
+    def prepare_ahead(cls, prefetched, preparer):
+        preparer.submit([path for path in prefetched.values() if not isinstance(path, GMSyncError)])
+
     def push_changes(self):
-        path = get_path(self.local_id, self.mp_cur)
+        path = self.prefetched
+        if path is None:
+            raise LocalOutdated
+        if isinstance(path, GMSyncError):
+            raise path
         self.log.info("song path: %s", path)
 
-        new_ids = self.api.upload(path)
+        #If we've uploaded this audio before (eg the file was moved or re-imported), reuse that song.
+        try:
+            file_hash = cached_hash(path, self.ids)
+        except (IOError, OSError):
+            self.log.warning("could not hash %s", path)
+            file_hash = None
+
+        if file_hash is not None:
+            gm_id = self.ids.claim_song_hash(file_hash)
+            if gm_id is not None:
+                self.log.info("already uploaded as %s - skipping upload", gm_id)
+                return HandlerResult(action='create', item_type='song', gm_id=gm_id)
 
-        #Assume that we start from an empty library.
-        if new_ids.get(path) is None:
+        #Songs GM won't take as they are get transcoded; the hash above stays that of the original.
+        with self.prepared(path) as upload_path:
+            new_ids = self.api.upload(upload_path)
+
+        if new_ids.get(upload_path) is None:
             raise CallFailure #CallFailure not raised by upload, since partial success can happen.
 
-        return HandlerResult(action='create', item_type='song', gm_id=new_ids[path])
+        if file_hash is not None:
+            self.ids.add_song_hash(file_hash, new_ids[upload_path])
+
+        return HandlerResult(action='create', item_type='song', gm_id=new_ids[upload_path])
 
 
 class uSongHandler(Handler):
+    item_type = 'song'
+    action = 'update'
+    covered_by_create = True
+    max_batch = 100
+    reconciles = True
+
+    @classmethod
+    def prefetch(cls, local_ids, mp_cur):
+        return dict((r['ID'], r) for r in select_in(mp_cur, "SELECT ID, %s FROM Songs WHERE ID IN (%%s)" % mm_sql_cols, local_ids))
+
+    @classmethod
+    def out_of_date(cls, local_id, prefetched, remote, id_db):
+        if prefetched is None:
+            return False
+
+        #only compare what the remote song has; values go through json, as they do when pushed
+        gm_song = json.loads(json.dumps(to_gm_song(prefetched)))
+        return any(k in remote and remote[k] != v for k, v in gm_song.items())
+
     def push_changes(self):
-        mm_md = self.mp_cur.execute("SELECT %s FROM Songs WHERE ID=?" % mm_sql_cols, (self.local_id,)).fetchone()
-        
-        if mm_md is None:
-            raise LocalOutdated
+        self.push_batch([self])
+
+    @classmethod
+    def push_batch(cls, handlers):
+        log = handlers[0].log
 
-        gm_song = {}
-        for col in mm_md.keys():
-            mdm = col_to_mdm[col]
+        local_ids = [h.local_id for h in handlers]
+        mm_mds = dict((h.local_id, h.prefetched) for h in handlers if h.prefetched is not None)
 
-            gm_key = mdm.gm_key
-            data = mdm.to_gm_form(mm_md[col])
+        #Only send what changed since the last push; MM rewrites identical values a lot, eg during library scans.
+        pushed = handlers[0].ids.get_song_metadata(local_ids)
 
-            gm_song[gm_key] = data
+        gm_songs = []
+        new_mds = {}
+        outdated = 0
+        for h in handlers:
+            mm_md = mm_mds.get(h.local_id)
 
-        gm_song['id'] = self.gms_id
-        self.log.info("new metadata: %s", repr(gm_song))
+            if mm_md is None:
+                log.info("local outdated - skipping metadata for local id %s", h.local_id)
+                outdated += 1
+                continue
 
-        self.api.change_song_metadata(gm_song) #TODO should switch this to a safer method
+            #round trip through json so values compare the same way they're stored
+            new_md = json.loads(json.dumps(to_gm_song(mm_md)))
+            old_md = pushed.get(h.local_id, {})
+
+            gm_song = dict((k, v) for k, v in new_md.items() if k not in old_md or old_md[k] != v)
+            if not gm_song:
+                continue
+
+            gm_song['id'] = h.gms_id
+            gm_songs.append(gm_song)
+            new_mds[h.local_id] = new_md
+
+        if outdated == len(handlers):
+            raise LocalOutdated
+
+        if not gm_songs:
+            log.info("no metadata changed")
+            return [None] * len(handlers)
+
+        log.info("new metadata: %s", repr(gm_songs))
+
+        handlers[0].api.change_song_metadata(gm_songs) #TODO should switch this to a safer method
+        handlers[0].ids.set_song_metadata(new_mds)
+
+        return [None] * len(handlers)
     
 class dSongHandler(Handler):
+    item_type = 'song'
+    action = 'delete'
+
     def push_changes(self):
-        delIds = self.api.delete_songs(self.gms_id)
+        gm_id = self.gms_id
+
+        #Keep the remote song while other local songs share it,
+        # or for a while in case its audio comes back (the service deletes it later).
+        if self.ids.song_refcount(gm_id) > 1 or self.ids.tombstone_song(gm_id):
+            self.log.info("keeping remote song %s for now", gm_id)
+            return HandlerResult(action='delete', item_type='song', gm_id=gm_id)
+
+        delIds = self.api.delete_songs(gm_id)
+        self.ids.drop_song_hashes(delIds)
 
         return HandlerResult(action='delete', item_type='song', gm_id=delIds[0])
 
 class cPlaylistHandler(Handler):
+    item_type = 'playlist'
+    action = 'create'
+
+    @classmethod
+    def prefetch(cls, local_ids, mp_cur):
+        return get_playlist_names(local_ids, mp_cur)
+
     def push_changes(self):
         #currently assuming that this is called prior to any inserts on PlaylistSongs
-        playlist_data = self.mp_cur.execute("SELECT PlaylistName FROM Playlists WHERE IDPlaylist=?", (self.local_id,)).fetchone()
+        name = self.prefetched
         
-        if playlist_data is None:
+        if name is None:
             raise LocalOutdated
 
-        self.log.info("new playlist: %s", playlist_data[0])
+        self.log.info("new playlist: %s", name)
 
-        new_gm_pid = self.api.create_playlist(playlist_data[0])
+        new_gm_pid = self.api.create_playlist(name)
 
         return HandlerResult(action='create', item_type='playlist', gm_id=new_gm_pid)
 
 class uPlaylistNameHandler(Handler):
+    item_type = 'playlist'
+    action = 'update'
+    covered_by_create = True
+    reconciles = True
+
+    @classmethod
+    def prefetch(cls, local_ids, mp_cur):
+        return get_playlist_names(local_ids, mp_cur)
+
+    @classmethod
+    def out_of_date(cls, local_id, prefetched, remote, id_db):
+        return prefetched is not None and prefetched != remote['name']
+
     def push_changes(self):
-        playlist_data = self.mp_cur.execute("SELECT PlaylistName FROM Playlists WHERE IDPlaylist=?", (self.local_id,)).fetchone()
+        name = self.prefetched
 
-        if playlist_data is None:
+        if name is None:
             raise LocalOutdated
 
-        self.log.info("updated playlist name: %s", playlist_data[0])
+        self.log.info("updated playlist name: %s", name)
 
-        self.api.change_playlist_name(self.gmp_id, playlist_data[0])
+        self.api.change_playlist_name(self.gmp_id, name)
 
 class dPlaylistHandler(Handler):
+    item_type = 'playlist'
+    action = 'delete'
+
     def push_changes(self):
         self.api.delete_playlist(self.gmp_id)
 
         return HandlerResult(action='delete', item_type='playlist', gm_id=self.gmp_id)    
 
+def playlist_delta(snapshot, entries):
+    """Return (removed, added) to turn playlist *snapshot* into *entries*, or None if that needs a full replacement.
+
+    Both are ordered lists of (localEntryId, gmSongId). removed and added are lists of those entries.
+
+    GM can only remove every entry of a song from a playlist and append songs to the end, so this is only possible when
+    entries common to both keep their order, every new entry comes after them, and no removed song is still in the playlist."""
+
+    if snapshot is None:
+        return None
+
+    old_ids = set(entry_id for entry_id, gm_song_id in snapshot)
+    new_ids = set(entry_id for entry_id, gm_song_id in entries)
+
+    removed = [e for e in snapshot if e[0] not in new_ids]
+    kept = [e for e in snapshot if e[0] in new_ids]
+
+    #Entries we're keeping need to lead the new playlist, in the same order, still pointing at the same songs
+    # (a song that's been uploaded again has a new GM id, and the old one is gone).
+    if [tuple(e) for e in entries[:len(kept)]] != [tuple(e) for e in kept]:
+        return None
+
+    added = entries[len(kept):]
+    if any(entry_id in old_ids for entry_id, gm_song_id in added):
+        return None
+
+    kept_songs = set(gm_song_id for entry_id, gm_song_id in kept)
+    if any(gm_song_id in kept_songs for entry_id, gm_song_id in removed):
+        return None
+
+    return removed, added
+
 class changePlaylistHandler(Handler):
+    item_type = 'playlist'
+    action = 'update' #cPlaylistHandler creates an empty playlist, so creates don't cover this.
+    reconciles = True
+
+    @classmethod
+    def prefetch(cls, local_ids, mp_cur):
+        #Get all the songs now in each playlist that still exists, in order.
+        playlists = dict((r['IDPlaylist'], []) for r in select_in(mp_cur, "SELECT IDPlaylist FROM Playlists WHERE IDPlaylist IN (%s)", local_ids))
+
+        for r in select_in(mp_cur, "SELECT IDPlaylist, IDPlaylistSong, IDSong FROM PlaylistSongs WHERE IDPlaylist IN (%s) ORDER BY IDPlaylist, SongOrder, IDPlaylistSong", local_ids):
+            if r['IDPlaylist'] in playlists:
+                playlists[r['IDPlaylist']].append(r)
+
+        return playlists
+
+    @classmethod
+    def out_of_date(cls, local_id, prefetched, remote, id_db):
+        if prefetched is None or 'songs' not in remote:
+            return False
+
+        gm_ids = id_db.get_gm_ids([r['IDSong'] for r in prefetched], 'song')
+        return [gm_ids[r['IDSong']] for r in prefetched if r['IDSong'] in gm_ids] != remote['songs']
+
     def push_changes(self):
-        #All playlist updates are handled idempotently.
+        #Playlist updates are sent as a delta from the last pushed version where possible, and otherwise idempotently.
         
         #Ensure the playlist exists.
-        if self.mp_cur.execute("SELECT IDPlaylist FROM Playlists WHERE IDPlaylist=?", (self.local_id,)).fetchone() is None:
+        song_rows = self.prefetched
+        if song_rows is None:
             raise LocalOutdated
 
-        #Get all the songs now in the playlist.
-        song_rows = self.mp_cur.execute("SELECT IDSong FROM PlaylistSongs WHERE IDPlaylist=? ORDER BY SongOrder", (self.local_id,)).fetchall()
+        #Resolve each distinct song once, then build the new playlist in order, dupes included.
+        #This also waits for songs that are still uploading.
+        gm_ids = self.get_gm_ids([r['IDSong'] for r in song_rows], 'song')
+
+        entries = [(r['IDPlaylistSong'], gm_ids[r['IDSong']]) for r in song_rows if r['IDSong'] in gm_ids]
+        delta = playlist_delta(self.ids.get_playlist_snapshot(self.local_id), entries)
+
+        if delta is None:
+            self.log.info("replacing playlist with %s songs", len(entries))
+            self.api.change_playlist(self.gmp_id, [{'id': gm_song_id} for entry_id, gm_song_id in entries]) #change_playlist takes a list of song dictionaries
+            self.ids.set_playlist_snapshot(self.local_id, entries)
+
+        else:
+            removed, added = delta
+            self.log.info("playlist delta: removing %s songs, adding %s songs", len(removed), len(added))
 
-        #Build the new playlist.
-        pl = []
-        for r in song_rows:
-            #Would like to do this all in one query, but don't know how since there can be dupes.
-            r_id_row = self.id_cur.execute("SELECT gmId FROM GMSongIds WHERE localId = ?", (r['IDSong'],)).fetchone()
-            if r_id_row is not None:
-                pl.append({'id':r_id_row[0]}) #change_playlist takes a list of song dictionaries
+            if removed:
+                self.api.remove_songs_from_playlist(self.gmp_id, list(set(gm_song_id for entry_id, gm_song_id in removed)))
+            if added:
+                self.api.add_songs_to_playlist(self.gmp_id, [gm_song_id for entry_id, gm_song_id in added])
 
-        self.api.change_playlist(self.gmp_id, pl)
+            self.ids.update_playlist_snapshot(self.local_id, [entry_id for entry_id, gm_song_id in removed], added)
 
 
 #Define how to set up the connection, since MediaMonkey needs a custom collation function.
 #It won't allow string queries without it.
 #Credit to Sproaticus: http://www.mediamonkey.com/forum/viewtopic.php?p=127635#127635
-def make_connection(db_path):
-    """Return a connection to MediaMonkey database at *db_path*."""
+def make_connection(db_path, **kwargs):
+    """Return a connection to MediaMonkey database at *db_path*. *kwargs* are passed to sqlite3.connect."""
 
     def iUnicodeCollate(s1, s2):
         return cmp(s1.lower(), s2.lower())
 
-    conn = sqlite3.connect(db_path, timeout=60) #MM locks the database for an obscenely long time
+    conn = sqlite3.connect(db_path, timeout=60, **kwargs) #MM locks the database for an obscenely long time
     conn.row_factory = sqlite3.Row
     conn.create_collation('IUNICODE', iUnicodeCollate)
     #There are also USERLOCALE and NUMERICSTRING collations referred to here:
@@ -220,6 +502,10 @@ def make_connection(db_path):
 
 
 config = MPConf(make_connection=make_connection,
+                bootstrap = [
+        BootstrapDef(table='Songs', id_col='ID', handlers=[cSongHandler]),
+        BootstrapDef(table='Playlists', id_col='IDPlaylist', handlers=[cPlaylistHandler, changePlaylistHandler]),
+        ],
                 action_pairs = [             
         ActionPair(
             trigger = TriggerDef(
@@ -270,7 +556,8 @@ config = MPConf(make_connection=make_connection,
                 id_text='old.IDPlaylist'),
             handler = dPlaylistHandler),
 
-        #it would be possible to do delta updates by grabbing IDPlaylistSong instead.
+        #changePlaylistHandler diffs the playlist's IDPlaylistSongs against the last pushed snapshot,
+        # so these only need to identify the playlist.
         ActionPair(
             trigger = TriggerDef(
                 name='sync2gm_addPlaylistSong',
@@ -0,0 +1,158 @@
+"""Counters and latency histograms for the service, cheap enough to read on every scrape."""
+
+import threading
+import bisect
+
+
+class Histogram(object):
+    """Counts observations into cumulative buckets, like a Prometheus histogram."""
+
+    #upper bounds in seconds; anything slower only counts towards +Inf
+    default_bounds = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self, bounds=None):
+        self.bounds = tuple(bounds or self.default_bounds)
+        self._counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """Return a dict of the cumulative bucket counts, as a list of [upper bound, count], the sum and the count."""
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds, self._counts):
+            total += count
+            buckets.append([bound, total])
+
+        return {'buckets': buckets, 'sum': round(self.sum, 6), 'count': self.count}
+
+
+class Metrics(object):
+    """Named counters and histograms, optionally keyed by a label (eg a handler name).
+
+    Everything is kept in memory and updated under one lock, so recording is a dict lookup
+    and reading never touches a database."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {} #name -> {label -> count}
+        self._histograms = {} #name -> {label -> Histogram}
+
+    def inc(self, name, label=None, n=1):
+        """Add *n* to counter *name* for *label*."""
+        with self._lock:
+            counts = self._counters.setdefault(name, {})
+            counts[label] = counts.get(label, 0) + n
+
+    def observe(self, name, value, label=None):
+        """Record *value* seconds in histogram *name* for *label*."""
+        with self._lock:
+            hists = self._histograms.setdefault(name, {})
+            if label not in hists:
+                hists[label] = Histogram()
+            hists[label].observe(value)
+
+    def count(self, name, label=None):
+        """Return the value of counter *name* for *label*."""
+        with self._lock:
+            return self._counters.get(name, {}).get(label, 0)
+
+    def counters(self, name):
+        """Return a dict mapping each label of counter *name* to its value."""
+        with self._lock:
+            return dict(self._counters.get(name, {}))
+
+    def histograms(self, name):
+        """Return a dict mapping each label of histogram *name* to its snapshot."""
+        with self._lock:
+            return dict((label, h.snapshot()) for label, h in self._histograms.get(name, {}).items())
+
+
+#How each top-level stat is exposed in the Prometheus text format: stat name -> (metric type, help).
+#Stats that are dicts keyed by handler are labelled with handler="..."; api stats are labelled with lane="...".
+prometheus_stats = [
+    ('pending_changes', 'gauge', 'Changes logged but not yet handled.'),
+    ('last_change_id', 'gauge', 'The id of the last change handled.'),
+    ('in_flight', 'gauge', 'Changes being pushed on the worker pool.'),
+    ('since_last_push', 'gauge', 'Seconds since a change was last pushed successfully.'),
+    ('lock_retries', 'counter', 'Times the mediaplayer database was locked when reading changes.'),
+    ('lock_wait_seconds', 'counter', 'Seconds spent waiting for the mediaplayer database to be unlocked, when reading changes.'),
+    ('id_cache_hits', 'counter', 'Id lookups answered from memory.'),
+    ('id_cache_misses', 'counter', 'Id lookups that went to the id database.'),
+    ('id_cache_items', 'gauge', 'Id mappings held in memory.'),
+    ('changes_table_rows', 'gauge', 'Rows left in sync2gm_Changes after the last complete prune.'),
+    ('changes_pruned', 'counter', 'Handled rows deleted from sync2gm_Changes.'),
+    ('since_last_prune', 'gauge', 'Seconds since sync2gm_Changes was last pruned completely.'),
+    ('changes_handled', 'counter', 'Changes pushed successfully, per handler.'),
+    ('changes_failed', 'counter', 'Changes that failed to push, per handler.'),
+    ('handler_latency', 'histogram', 'Seconds to push a batch of changes, per handler.'),
+]
+
+#Numeric api lane stats to expose, and their metric types.
+prometheus_api_stats = [
+    ('calls', 'counter'),
+    ('errors', 'counter'),
+    ('slow_calls', 'counter'),
+    ('throttles', 'counter'),
+    ('in_flight', 'gauge'),
+    ('rate', 'gauge'),
+    ('concurrency', 'gauge'),
+    ('waited', 'counter'),
+]
+
+def _prom_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+def _prom_value(v):
+    return repr(v) if isinstance(v, float) else str(v)
+
+def format_prometheus(stats, prefix='sync2gm_', by_library=False):
+    """Return the dict from ChangePollThread.stats, *stats*, in the Prometheus text exposition format.
+
+    When *by_library* is True, *stats* maps each library name to its dict instead, and every sample
+    is labelled with library="<name>"."""
+    libraries = sorted(stats.items()) if by_library else [(None, stats)]
+    lines = []
+
+    def labels(library, *rest):
+        return _prom_labels(([('library', library)] if library is not None else []) + list(rest))
+
+    for name, kind, help_text in prometheus_stats:
+        values = [(library, lib_stats.get(name)) for library, lib_stats in libraries if lib_stats.get(name) is not None]
+        if not values:
+            continue
+
+        metric = prefix + name
+        lines.append('# HELP %s %s' % (metric, help_text))
+        lines.append('# TYPE %s %s' % (metric, kind))
+
+        for library, value in values:
+            if kind == 'histogram':
+                for handler, hist in sorted(value.items()):
+                    for bound, count in hist['buckets']:
+                        lines.append('%s_bucket%s %s' % (metric, labels(library, ('handler', handler), ('le', bound)), count))
+                    lines.append('%s_bucket%s %s' % (metric, labels(library, ('handler', handler), ('le', '+Inf')), hist['count']))
+                    lines.append('%s_sum%s %s' % (metric, labels(library, ('handler', handler)), _prom_value(hist['sum'])))
+                    lines.append('%s_count%s %s' % (metric, labels(library, ('handler', handler)), hist['count']))
+            elif isinstance(value, dict):
+                for handler, count in sorted(value.items()):
+                    lines.append('%s%s %s' % (metric, labels(library, ('handler', handler)), _prom_value(count)))
+            else:
+                lines.append('%s%s %s' % (metric, labels(library), _prom_value(value)))
+
+    #libraries sharing an account report the same lanes
+    for name, kind in prometheus_api_stats:
+        metric = prefix + 'api_' + name
+        lines.append('# TYPE %s %s' % (metric, kind))
+        for library, lib_stats in libraries:
+            for lane, lane_stats in sorted(lib_stats.get('api', {}).items()):
+                lines.append('%s%s %s' % (metric, labels(library, ('lane', lane)), _prom_value(lane_stats[name])))
+
+    return '\n'.join(lines) + '\n'
@@ -1,18 +1,24 @@
 from collections import namedtuple
+import contextlib
 
 
 class GMSyncError(Exception):
     """Base class for any error originating during syncing."""
     pass
 
+class UnmappedId(GMSyncError):
+    """Raised when we expect that a mapping exists between local/remote ids,
+    but one does not."""
+    pass
+
 class LocalOutdated(Exception):
     """Raised when a handler expects to find local information, but does not.
 
     This usually signals that the service is attempting to update a remote object
     that no longer exists."""
 
-#The configuration for a media player: the action pairs and how to connect.
-MPConf = namedtuple('MPConf', ['action_pairs', 'make_connection'])
+#The configuration for a media player: the action pairs, how to connect, and how to bootstrap.
+MPConf = namedtuple('MPConf', ['action_pairs', 'make_connection', 'bootstrap'])
 
 #A trigger/handler pair. A list of these defines how to respond to db changes.
 ActionPair = namedtuple('ActionPair', ['trigger', 'handler'])
@@ -20,6 +26,11 @@ ActionPair = namedtuple('ActionPair', ['trigger', 'handler'])
 #A definition of a trigger.
 TriggerDef = namedtuple('TriggerDef', ['name', 'table', 'when', 'id_text'])
 
+#Defines how to push items that existed before attaching to the local db.
+#Every id in *table*.*id_col* is pushed by each of *handlers* in turn, as if it had just been created.
+# handlers: Handler classes from the action pairs; creates are skipped for items that already have a mapping.
+BootstrapDef = namedtuple('BootstrapDef', ['table', 'id_col', 'handlers'])
+
 #Holds the result from a handler, so the service can keep local -> remote mapping up to date.
 # action: one of {'create', 'delete'}. Updates can just return an empty HandlerResult.
 # itemType: one of {'song', 'playlist'}
@@ -32,6 +43,10 @@ HandlerResult = namedtuple('HandlerResult', ['action', 'item_type', 'gm_id'])
 #They do not need to check for success, but can raise CallFailure,
 # sqlite.Error or UnmappedId, which the service will handle.
 
+#Pushing is split in two: the service first calls each handler's prefetch to read everything a window of
+# changes needs from the mediaplayer db, in one short read transaction, then pushes them with no mediaplayer
+# connection at all. This keeps slow api calls from holding the mediaplayer's locks.
+
 #All handlers that create/delete remote items must return a HandlerResult.
 #This allows the service to keep track of local -> remote mappings.
 
@@ -40,19 +55,49 @@ class Handler(object):
 
     A mediaplayer config defines one for each kind of local change (eg the addition of a song)."""
 
-    def __init__(self, local_id, api, mp_conn, gmid_conn, get_gm_id, logger):
+    #Describe the change this Handler pushes, so the service can coalesce a window of changes.
+    # item_type: one of {'song', 'playlist'}, or None to never coalesce this Handler's changes.
+    # action: one of {'create', 'update', 'delete'}.
+    # covered_by_create: for updates, True if a create of the same item already pushes this change.
+    item_type = None
+    action = 'update'
+    covered_by_create = False
+
+    #Handlers that can push changes for many items in one call set this above 1 and override push_batch.
+    #Batched changes may be pushed ahead of their place in the window, so only batch updates covered by creates.
+    max_batch = 1
+
+    #Handlers whose changes are slow and independent of each other (eg uploads) set this to run on
+    # the service's worker pool. Looking up the GM id of an item still being created there waits for it.
+    parallel = False
+
+    #Set by the service to whatever prefetch returned for this Handler's local_id, or None if there was nothing.
+    prefetched = None
+
+    #Update handlers that can tell when a remote item has drifted from the local one set this and override out_of_date,
+    # so reconciliation can push fixes through them.
+    reconciles = False
+
+    def __init__(self, local_id, api, mp_conn, gmid_conn, get_gm_id, logger, get_gm_ids=None, id_db=None, preparer=None):
         """Create an instance of a Handler. This is done by the service when a specific change is detected."""
  
         self.log = logger
         self.local_id = local_id
         self.api = api
 
-        #A cursor for the mediaplayer database.
-        self.mp_cur = mp_conn.cursor()
+        #A cursor for the mediaplayer database. This is None when pushing; read what's needed in prefetch.
+        self.mp_cur = mp_conn.cursor() if mp_conn is not None else None
 
         #A cursor for the id database - this shouldn't be needed in mediaplayer configs, they use gm{s,p}id.
         self.id_cur = gmid_conn.cursor()
         self._get_gm_id = get_gm_id #a func that takes localid, item_type, cursor and returns the matching GM id, or raises UnmappedId
+        self._get_gm_ids = get_gm_ids #a func that takes localids, item_type and returns a dict of the mapped ones to their GM ids
+
+        #The service's IdDatabase, for handlers that keep their own state there (eg playlist snapshots).
+        self.ids = id_db
+
+        #The service's prepare.Preparer, which transcodes files for upload; use it through prepared().
+        self.preparer = preparer
 
 
     #The handler can use gms_id and/or gmp_id to get their remote id on the fly.
@@ -69,12 +114,73 @@ class Handler(object):
         self.log.info("gmp_id: %s", pid)
         return pid 
 
+    @classmethod
+    def prefetch(cls, local_ids, mp_cur):
+        """Return a dict mapping some of *local_ids* to data push_changes will need, read at once using *mp_cur*.
+
+        The service calls this for every change before pushing any of them, inside one read transaction;
+        each handler then finds its entry in self.prefetched. Return plain data (eg rows, not cursors), since it's
+        used after the transaction ends. Leave out items that no longer exist locally."""
+
+        return {}
+
+    @classmethod
+    def out_of_date(cls, local_id, prefetched, remote, id_db):
+        """Return True if remote item dict *remote* needs this handler to push *local_id*, given what prefetch
+        returned for it (*prefetched*). *id_db* is the service's IdDatabase, for looking up other ids.
+
+        Only called for handlers that set reconciles."""
+
+        return False
+
+    @classmethod
+    def prepare_ahead(cls, prefetched, preparer):
+        """Start any slow work on what prefetch returned (*prefetched*), eg transcoding files with *preparer*,
+        so it's done by the time push_changes needs it. The service calls this after gathering, before pushing."""
+        pass
+
+    @contextlib.contextmanager
+    def prepared(self, path):
+        """Context manager giving the path to upload for the file at *path*, which may be a transcoded copy."""
+        if self.preparer is None:
+            yield path
+        else:
+            with self.preparer.prepared(path) as upload_path:
+                yield upload_path
+
+    def get_gm_ids(self, local_ids, item_type):
+        """Return a dict mapping each of *local_ids* that has a GM id for *item_type* to that id.
+
+        Use this to look up many items at once; unmapped items are left out instead of raising UnmappedId."""
+
+        if self._get_gm_ids is not None:
+            return self._get_gm_ids(local_ids, item_type)
+
+        gm_ids = {}
+        for local_id in set(local_ids):
+            try:
+                gm_ids[local_id] = self._get_gm_id(local_id, item_type, self.id_cur)
+            except UnmappedId:
+                pass
+
+        return gm_ids
+
     def push_changes(self):
         """Send changes to Google Music. This is implemented in mediaplayer configurations.
 
         This function does not need to handle failure. The service will handle gmusicapi.CallFailure, 
         sqlite3.Error, or sync2gm.UnmappedId.
 
-        api (already authenticated), mp_cur, gms_id, and gmp_id are provided for convinience."""
+        api (already authenticated), prefetched, gms_id, and gmp_id are provided for convinience."""
 
         raise NotImplementedError
+
+    @classmethod
+    def push_batch(cls, handlers):
+        """Send changes for *handlers*, a list of at most max_batch instances of this class, at once.
+
+        Return a list of the results of push_changes, in the same order.
+        If this raises, the service splits the batch and retries the halves, so one bad item
+        doesn't lose the rest."""
+
+        return [h.push_changes() for h in handlers]
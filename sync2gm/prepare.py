@@ -0,0 +1,301 @@
+"""Getting files ready to upload: transcoding the ones Google Music won't take as they are.
+
+Transcodes run on a process pool, so they use every core and don't hold up the upload threads. Results are kept
+in a cache directory, named by the hash of their contents, and looked up by the (path, size, mtime) of the
+source file, so uploading the same file again (eg after a delete or a failed upload) doesn't transcode it again."""
+
+import os
+import threading
+import contextlib
+import subprocess
+import multiprocessing
+from functools import partial
+from distutils.spawn import find_executable
+
+from hashing import hash_file
+
+
+#Files with these extensions are transcoded to mp3; everything else is uploaded as is.
+transcode_exts = ('.flac', '.wav', '.wma', '.ogg', '.ape', '.aif', '.aiff')
+
+#Programs that can transcode, in order of preference.
+converters = ('ffmpeg', 'avconv')
+
+def transcode(converter, src, cache_dir):
+    """Transcode *src* to an mp3 in *cache_dir* using *converter*, and return (hash, size) of the result.
+
+    This runs in the pool's processes, so it can't touch the id database."""
+    tmp_fn = os.path.join(cache_dir, 'tmp-%s.mp3' % os.getpid())
+
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([converter, '-v', 'error', '-y', '-i', src,
+                               '-map', '0:a', '-map_metadata', '0', '-id3v2_version', '3',
+                               '-codec:a', 'libmp3lame', '-q:a', '0', '-f', 'mp3', tmp_fn],
+                              stdout=devnull, stderr=devnull)
+
+    file_hash = hash_file(tmp_fn)
+    fn = os.path.join(cache_dir, file_hash + '.mp3')
+    if os.path.isfile(fn):
+        os.remove(tmp_fn) #the same audio came out before
+    else:
+        os.rename(tmp_fn, fn)
+
+    return file_hash, os.path.getsize(fn)
+
+def transcode_job(converter, src, cache_dir):
+    """Pool job: return (what transcode returned, None), or (None, the error) if it failed."""
+    try:
+        return transcode(converter, src, cache_dir), None
+    except Exception as e:
+        return None, repr(e)
+
+def hash_job(src):
+    """Pool job: return the hash of *src*, or None if it can't be read."""
+    try:
+        return hash_file(src)
+    except Exception:
+        return None
+
+
+class _Job(object):
+    """A file being prepared: hashed first (unless the hash is cached), then transcoded unless that audio was
+    already uploaded. finish() is called from the pool's result thread, so nothing waits on AsyncResults."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self.result = None #(hash, size) of the transcode
+        self.error = None
+        self.skipped = False #True if the audio was already uploaded, so it wasn't transcoded
+
+    def finish(self, outcome):
+        self.result, self.error = outcome
+        self._done.set()
+
+    def skip(self):
+        self.skipped = True
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self):
+        self._done.wait()
+
+
+class Preparer(object):
+    """Transcodes files ahead of their upload on a process pool, and caches the results.
+
+    The cache is indexed in the PreparedFiles table of the id database, and evicted least recently used first
+    once it holds more than max_bytes. Files being uploaded are never evicted.
+
+    Files are hashed before they're transcoded, also on the pool, and aren't transcoded if a song was already
+    uploaded with that hash (eg a file that was moved), since the upload will be skipped.
+
+    If no converter is installed, files are uploaded as they are."""
+
+    def __init__(self, cache_dir, id_db, log, max_bytes=2 << 30, processes=None, pool=None):
+        """*cache_dir* - where to keep transcoded files; it's created if needed
+        *id_db* - the service's IdDatabase
+        *processes* - the number of transcodes to run at once (default: the number of cores)
+        *pool* - a multiprocessing Pool to run on, shared with other libraries; by default we make our own when first needed,
+                 with *processes* processes"""
+        self.cache_dir = cache_dir
+        self.ids = id_db
+        self.log = log
+        self.max_bytes = max_bytes
+        self.processes = processes
+
+        self.converter = None
+        for name in converters:
+            self.converter = find_executable(name)
+            if self.converter: break
+        if self.converter is None:
+            self.log.warning("no %s found - songs will be uploaded without transcoding", ' or '.join(converters))
+
+        #A shared pool belongs to whoever made it, so we only stop using it when closed.
+        self._owns_pool = pool is None
+        self._pool = pool
+        self._closed = False
+        self._lock = threading.Lock()
+        self._jobs = {} #(path, size, mtime) -> _Job
+        self._in_use = {} #hash -> number of uploads using it
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._sweep()
+
+    def _sweep(self):
+        """Remove files left in the cache that the index doesn't know about, eg after a crash."""
+        known = self.ids.prepared_hashes()
+        for fn in os.listdir(self.cache_dir):
+            if os.path.splitext(fn)[0] not in known:
+                try:
+                    os.remove(os.path.join(self.cache_dir, fn))
+                except OSError:
+                    pass
+
+    def needs_transcode(self, path):
+        return self.converter is not None and os.path.splitext(path)[1].lower() in transcode_exts
+
+    def _key(self, path):
+        st = os.stat(path)
+        return (path, st.st_size, st.st_mtime)
+
+    def _cached_fn(self, file_hash):
+        return os.path.join(self.cache_dir, file_hash + '.mp3')
+
+    def submit(self, paths, force=False):
+        """Start preparing any of *paths* that need it and aren't cached, without waiting for them.
+
+        Unless *force* is True, files whose audio was already uploaded aren't transcoded."""
+        for path in paths:
+            if not self.needs_transcode(path):
+                continue
+
+            try:
+                key = self._key(path)
+            except OSError:
+                continue #the upload will fail by itself
+
+            with self._lock:
+                if self._closed or key in self._jobs or self.ids.get_prepared(*key) is not None:
+                    continue
+
+                if self._pool is None:
+                    self._pool = multiprocessing.Pool(self.processes)
+                job = self._jobs[key] = _Job()
+                pool = self._pool
+
+            if force:
+                self._transcode(key, job)
+                continue
+
+            file_hash = self.ids.get_file_hash(*key)
+            if file_hash is not None:
+                self._hashed(key, job, file_hash, cached=True)
+            else:
+                pool.apply_async(hash_job, (path,), callback=partial(self._hashed, key, job))
+
+    def _hashed(self, key, job, file_hash, cached=False):
+        """Transcode the file with *key* for *job*, now that its hash is known, unless it's already uploaded."""
+        try:
+            if file_hash is not None:
+                if not cached:
+                    #push_changes needn't hash it again
+                    self.ids.set_file_hash(key[0], key[1], key[2], file_hash)
+                if self.ids.has_song_hash(file_hash):
+                    job.skip()
+                    return
+
+            self._transcode(key, job)
+        except Exception as e:
+            job.finish((None, repr(e)))
+
+    def _transcode(self, key, job):
+        with self._lock:
+            pool = self._pool
+        if pool is None:
+            job.finish((None, 'closed'))
+            return
+
+        pool.apply_async(transcode_job, (self.converter, key[0], self.cache_dir), callback=job.finish)
+
+    @contextlib.contextmanager
+    def prepared(self, path):
+        """Context manager giving the path to upload for *path*: a cached transcode, or *path* itself.
+
+        If it needs transcoding and wasn't submitted, it's transcoded now. The cached file is kept
+        until the context exits. If transcoding fails, *path* is given as is."""
+
+        if not self.needs_transcode(path):
+            yield path
+            return
+
+        try:
+            key = self._key(path)
+        except OSError:
+            yield path
+            return
+
+        file_hash = self._get(key)
+        if file_hash is None:
+            yield path
+            return
+
+        try:
+            yield self._cached_fn(file_hash)
+        finally:
+            with self._lock:
+                self._in_use[file_hash] -= 1
+                if not self._in_use[file_hash]:
+                    del self._in_use[file_hash]
+
+    def _get(self, key):
+        """Return the hash of the transcode of the file with *key*, marked in use, waiting for it if needed, or None if it failed."""
+        self.submit([key[0]])
+
+        with self._lock:
+            file_hash = self.ids.get_prepared(*key)
+            job = self._jobs.get(key)
+
+        if file_hash is None and job is not None:
+            job.wait()
+
+            if job.skipped:
+                #it was already uploaded when submitted, but it's being uploaded now after all
+                with self._lock:
+                    if self._jobs.get(key) is job:
+                        del self._jobs[key]
+                self.submit([key[0]], force=True)
+                with self._lock:
+                    job = self._jobs.get(key)
+                if job is not None:
+                    job.wait()
+
+            if job is None or job.result is None:
+                self.log.error("could not transcode %s (%s) - uploading it as is", key[0], job.error if job is not None else 'closed')
+            else:
+                file_hash, size = job.result
+                with self._lock:
+                    self.ids.add_prepared(key[0], key[1], key[2], file_hash, size)
+
+            with self._lock:
+                if self._jobs.get(key) is job:
+                    del self._jobs[key]
+
+            if file_hash is not None:
+                self._evict()
+
+        #eviction happens under the lock too, so once it's marked in use it stays put
+        with self._lock:
+            if file_hash is None or not os.path.isfile(self._cached_fn(file_hash)):
+                return None
+
+            self._in_use[file_hash] = self._in_use.get(file_hash, 0) + 1
+
+        return file_hash
+
+    def _evict(self):
+        """Remove the least recently used files until the cache fits in max_bytes."""
+        with self._lock:
+            for file_hash in self.ids.prepared_to_evict(self.max_bytes, self._in_use):
+                self.ids.drop_prepared(file_hash)
+                try:
+                    os.remove(self._cached_fn(file_hash))
+                except OSError:
+                    pass
+
+    def close(self):
+        """Stop the pool, or stop using it if it's shared. Transcodes still running are abandoned; their leftovers are swept up next time."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+            self._closed = True
+            jobs = self._jobs.values()
+
+        if pool is not None and self._owns_pool:
+            pool.terminate()
+            pool.join()
+
+        for job in jobs:
+            if not job.done():
+                job.finish((None, 'closed'))
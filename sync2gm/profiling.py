@@ -0,0 +1,180 @@
+"""Optional timing of the service's hot paths, switched on and off at runtime.
+
+Timings are taken for a sampled fraction of changes and broken down into phases (eg id lookups, path
+lookups, api calls), each counted exclusive of the phases nested inside it. cProfile can also be run
+for a while on demand. When both are off, a timed call costs one attribute check."""
+
+import time
+import random
+import threading
+import functools
+import contextlib
+import cProfile
+
+
+class Profiler(object):
+    """Collects sampled per-phase timings, and cProfile dumps on request.
+
+    One is shared by the whole process (see *profiler* below), so module-level functions can be timed too."""
+
+    def __init__(self):
+        self.sample_rate = 0.0
+        self.enabled = False #True while sampling; checked before anything else
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._phases = {} #label -> {phase -> [total seconds, count]}
+        self._samples = {} #label -> number of samples
+
+        self._cprofile_until = None
+        self._cprofile_prefix = None
+        self._cprofile_dumps = []
+
+    def set_sample_rate(self, rate):
+        """Time a fraction *rate* (between 0 and 1) of changes from now on. 0 turns sampling off."""
+        self.sample_rate = max(0.0, min(1.0, float(rate)))
+        self.enabled = self.sample_rate > 0
+
+    def reset(self):
+        """Forget the timings collected so far."""
+        with self._lock:
+            self._phases = {}
+            self._samples = {}
+
+    @contextlib.contextmanager
+    def sample(self, label):
+        """Context manager around the handling of one or more changes, timed under *label* (eg a handler name)
+        if this one is sampled. Phases entered inside it on the same thread are added to its breakdown."""
+
+        if not self.enabled or getattr(self._local, 'stack', None) is not None or random.random() >= self.sample_rate:
+            yield
+            return
+
+        self._begin_sample()
+        try:
+            yield
+        finally:
+            self._end_sample(label)
+
+    def _begin_sample(self):
+        self._local.stack = [['total', time.time(), 0.0]]
+        self._local.phases = {}
+
+    def _end_sample(self, label):
+        name, start, nested = self._local.stack.pop()
+        phases = self._local.phases
+
+        #time in the sample but outside any phase
+        other = time.time() - start - nested
+        if other > 0:
+            phases['other'] = phases.get('other', 0.0) + other
+
+        self._local.stack = None
+        self._record(label, phases)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager timing phase *name* of the current sample. Outside a sample, it can be a sample by itself."""
+        if not self.enabled:
+            yield
+            return
+
+        outside = getattr(self._local, 'stack', None) is None
+        if outside:
+            if random.random() >= self.sample_rate:
+                yield
+                return
+            self._begin_sample()
+
+        stack = self._local.stack
+        stack.append([name, time.time(), 0.0])
+        try:
+            yield
+        finally:
+            name, start, nested = stack.pop()
+            elapsed = time.time() - start
+            stack[-1][2] += elapsed
+            self._local.phases[name] = self._local.phases.get(name, 0.0) + (elapsed - nested)
+
+            if outside:
+                self._end_sample(name)
+
+    def timed(self, name):
+        """Decorator timing each call of a function as phase *name*."""
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return f(*args, **kwargs)
+                with self.phase(name):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _record(self, label, phases):
+        with self._lock:
+            self._samples[label] = self._samples.get(label, 0) + 1
+            totals = self._phases.setdefault(label, {})
+            for name, seconds in phases.items():
+                total = totals.setdefault(name, [0.0, 0])
+                total[0] += seconds
+                total[1] += 1
+
+    def start_cprofile(self, seconds, prefix):
+        """Run cProfile in every thread that passes through cprofiled() for the next *seconds* seconds.
+
+        Each thread's profile is dumped to *prefix*-<thread name>.prof when it next passes through
+        cprofiled() once the time is up; a thread that's gone idle dumps when it wakes."""
+        with self._lock:
+            self._cprofile_until = time.time() + seconds
+            self._cprofile_prefix = prefix
+            self._cprofile_dumps = []
+
+    @contextlib.contextmanager
+    def cprofiled(self):
+        """Context manager around a unit of a thread's work (eg a polling pass), run under cProfile while a capture is on."""
+        if self._cprofile_until is None and getattr(self._local, 'cprofile', None) is None:
+            yield
+            return
+
+        prof = getattr(self._local, 'cprofile', None)
+        if prof is None:
+            prof = self._local.cprofile = cProfile.Profile()
+
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+
+            until = self._cprofile_until
+            if until is None or time.time() >= until:
+                self._dump_cprofile(prof)
+
+    def _dump_cprofile(self, prof):
+        self._local.cprofile = None
+        fn = '%s-%s.prof' % (self._cprofile_prefix, threading.current_thread().name)
+        prof.dump_stats(fn)
+
+        with self._lock:
+            self._cprofile_dumps.append(fn)
+            if self._cprofile_until is not None and time.time() >= self._cprofile_until:
+                self._cprofile_until = None
+
+    def stats(self):
+        """Return a dict of the sample rate, the number of samples per label, and per label,
+        the mean seconds per sample spent in each phase."""
+        with self._lock:
+            breakdown = {}
+            for label, totals in self._phases.items():
+                breakdown[label] = dict((name, round(total / self._samples[label], 6)) for name, (total, count) in totals.items())
+
+            return {'sample_rate': self.sample_rate,
+                    'samples': dict(self._samples),
+                    'mean_phase_seconds': breakdown,
+                    'cprofile_running': self._cprofile_until is not None,
+                    'cprofile_dumps': list(self._cprofile_dumps)}
+
+
+#The profiler for the process.
+profiler = Profiler()
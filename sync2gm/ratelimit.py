@@ -0,0 +1,256 @@
+"""Pacing for Google Music calls, shared by everything using the same Api."""
+
+import os
+import time
+import threading
+
+from gmusicapi import CallFailure
+
+from profiling import profiler
+
+
+class Lane(object):
+    """Paces one kind of call with a token bucket and a limit on calls in flight.
+
+    Both adapt AIMD-style: every call that succeeds in under *target_latency* seconds nudges them
+    back up towards their configured ceilings, and a failure or slow call halves them. Calls that
+    started before the last backoff can't cause another one, so a burst of errors only counts once.
+
+    Calls whose time grows with their size (eg uploads) are judged by their latency per unit of size instead;
+    see release()."""
+
+    #how far one good call raises the rate, as a fraction of the ceiling
+    rate_step = 0.05
+
+    #the rate never drops below this fraction of the ceiling
+    min_rate_fraction = 0.05
+
+    def __init__(self, name, rate, burst, concurrency, target_latency):
+        """*rate* is in calls per second, and *burst* is the most calls that can be made at once after idling."""
+        self.name = name
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.burst = burst
+        self.max_concurrency = concurrency
+        self.concurrency = float(concurrency)
+        self.target_latency = target_latency
+
+        self._tokens = float(burst)
+        self._refilled = time.time()
+        self._active = 0
+        self._backed_off = 0 #time of the last backoff
+        self._cond = threading.Condition()
+
+        self.calls = 0
+        self.errors = 0
+        self.slow_calls = 0
+        self.throttles = 0 #the number of backoffs
+        self.waited = 0.0 #total seconds spent waiting to make a call
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def acquire(self):
+        """Block until a call can be made, and return its start time, to be passed to release()."""
+        start_wait = time.time()
+
+        with self._cond:
+            while True:
+                self._refill()
+
+                if self._active < int(self.concurrency):
+                    if self._tokens >= 1:
+                        break
+                    timeout = (1 - self._tokens) / self.rate
+                else:
+                    timeout = None #until a call finishes
+
+                self._cond.wait(timeout)
+
+            self._tokens -= 1
+            self._active += 1
+
+            now = time.time()
+            self.waited += now - start_wait
+            return now
+
+    def release(self, start, failed, scale=1):
+        """Record the end of a call started at *start*, and whether it *failed*.
+
+        Its latency is divided by *scale* before it's compared with target_latency, eg by the size of an upload in MB."""
+        latency = (time.time() - start) / max(1.0, scale)
+
+        with self._cond:
+            self._active -= 1
+            self.calls += 1
+            if failed: self.errors += 1
+
+            slow = latency > self.target_latency
+            if slow: self.slow_calls += 1
+
+            if failed or slow:
+                if start >= self._backed_off:
+                    self._backed_off = time.time()
+                    self.throttles += 1
+                    self.concurrency = max(1.0, self.concurrency / 2)
+                    self.rate = max(self.max_rate * self.min_rate_fraction, self.rate / 2)
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                self.rate = min(self.max_rate, self.rate + self.max_rate * self.rate_step)
+
+            self._cond.notify_all()
+
+    def stats(self):
+        """Return a dict of the current limits and counters."""
+        with self._cond:
+            return {'rate': round(self.rate, 3),
+                    'max_rate': self.max_rate,
+                    'concurrency': int(self.concurrency),
+                    'max_concurrency': self.max_concurrency,
+                    'in_flight': self._active,
+                    'calls': self.calls,
+                    'errors': self.errors,
+                    'slow_calls': self.slow_calls,
+                    'throttles': self.throttles,
+                    'last_throttle': self._backed_off or None,
+                    'waited': round(self.waited, 3)}
+
+
+class ByteBudget(object):
+    """Bounds the bytes of the files being uploaded at once, and optionally the average upload bandwidth.
+
+    The upload itself happens inside the Api, so bandwidth is shaped by holding back the start of each upload
+    until the bytes before it have been paid for at *bandwidth* bytes per second; up to *burst* seconds' worth
+    can go out at once after idling."""
+
+    def __init__(self, max_bytes, bandwidth=None, burst=5):
+        """*max_bytes* - the most bytes in flight at once; a file bigger than this is uploaded alone
+        *bandwidth* - the most bytes per second on average, or None for no limit"""
+        self.max_bytes = max_bytes
+        self.bandwidth = bandwidth
+        self.burst = burst
+
+        self._in_flight = 0
+        self._paid_until = time.time() #when the bytes started so far have been paid for
+        self._cond = threading.Condition()
+
+        self.bytes = 0 #total bytes started
+        self.waited = 0.0
+
+    def acquire(self, size):
+        """Block until an upload of *size* bytes can start."""
+        start_wait = time.time()
+
+        with self._cond:
+            while self._in_flight and self._in_flight + size > self.max_bytes:
+                self._cond.wait()
+
+            if self.bandwidth:
+                while 1:
+                    ahead = self._paid_until - time.time() - self.burst
+                    if ahead <= 0:
+                        break
+                    self._cond.wait(ahead)
+
+                self._paid_until = max(self._paid_until, time.time()) + float(size) / self.bandwidth
+
+            self._in_flight += size
+            self.bytes += size
+            self.waited += time.time() - start_wait
+
+    def release(self, size):
+        with self._cond:
+            self._in_flight -= size
+            self._cond.notify_all()
+
+    def stats(self):
+        """Return a dict of the current limits and counters."""
+        with self._cond:
+            return {'bytes_in_flight': self._in_flight,
+                    'max_bytes': self.max_bytes,
+                    'bandwidth': self.bandwidth,
+                    'bytes': self.bytes,
+                    'bytes_waited': round(self.waited, 3)}
+
+def upload_size(filenames):
+    """Return the total size in bytes of *filenames*, the argument to Api.upload: a filename or a list of them."""
+    if isinstance(filenames, basestring):
+        filenames = [filenames]
+
+    size = 0
+    for fn in filenames:
+        try:
+            size += os.path.getsize(fn)
+        except OSError:
+            pass #the upload will fail by itself
+
+    return size
+
+
+class LimitedApi(object):
+    """Wraps an Api so every call goes through a Lane: one for uploads, and one for everything else.
+
+    Share one between everything using the same account."""
+
+    #calls that go through the upload lane
+    upload_calls = ('upload',)
+
+    #calls that aren't paced at all
+    unlimited_calls = ('login', 'logout', 'is_authenticated')
+
+    def __init__(self, api, upload_rate=1.0, call_rate=5.0, upload_concurrency=4, call_concurrency=4,
+                 upload_latency=30, call_latency=10, upload_max_bytes=256 << 20, upload_bandwidth=None):
+        """*upload_rate* and *call_rate* are the most calls per second for each lane,
+        and *upload_concurrency* and *call_concurrency* the most in flight at once.
+        *call_latency* is the seconds past which a call counts as slow, and *upload_latency* the seconds per MB
+        past which an upload does (files under a MB count as one), so big files aren't slow just for being big.
+        *upload_max_bytes* and *upload_bandwidth* are passed to the ByteBudget uploads go through."""
+        self.api = api
+        self.lanes = {'upload': Lane('upload', upload_rate, max(1, upload_concurrency), upload_concurrency, upload_latency),
+                      'call': Lane('call', call_rate, max(1, int(call_rate)), call_concurrency, call_latency)}
+        self.upload_budget = ByteBudget(upload_max_bytes, upload_bandwidth)
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+
+        if name.startswith('_') or name in self.unlimited_calls or not callable(attr):
+            return attr
+
+        is_upload = name in self.upload_calls
+        lane = self.lanes['upload' if is_upload else 'call']
+
+        def limited(*args, **kwargs):
+            size = upload_size(args[0]) if is_upload and args else 0
+
+            with profiler.phase('api_wait'):
+                if is_upload: self.upload_budget.acquire(size)
+                start = lane.acquire()
+            failed = False
+            try:
+                with profiler.phase('api'):
+                    result = attr(*args, **kwargs)
+
+                #uploads don't raise when a file fails; it's just left out of the result
+                if is_upload and args:
+                    filenames = [args[0]] if isinstance(args[0], basestring) else args[0]
+                    failed = not isinstance(result, dict) or any(result.get(fn) is None for fn in filenames)
+
+                return result
+            except CallFailure:
+                failed = True
+                raise
+            finally:
+                #time spent waiting on the ByteBudget isn't counted, since it's before start
+                lane.release(start, failed, float(size) / (1 << 20) if is_upload else 1)
+                if is_upload: self.upload_budget.release(size)
+
+        limited.__name__ = name
+        return limited
+
+    def stats(self):
+        """Return a dict mapping each lane name to its stats. The upload lane's include the ByteBudget's."""
+        stats = dict((name, lane.stats()) for name, lane in self.lanes.items())
+        stats['upload'].update(self.upload_budget.stats())
+        return stats
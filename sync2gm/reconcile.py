@@ -0,0 +1,191 @@
+"""Full-state reconciliation: compare the mediaplayer db, the id database and the remote library,
+and work out the fewest changes to bring them back in line.
+
+The trigger stream only ever sees changes, so anything lost along the way (eg a change that was dead-lettered,
+or made while the triggers were detached) would otherwise stay out of sync for good."""
+
+from collections import namedtuple
+
+from gmusicapi import CallFailure
+
+
+#One change needed to bring an item back in sync.
+# action: one of
+#   'upload' - the item exists locally but was never pushed
+#   'remap' - the item is mapped to a remote item that no longer exists, so it's pushed again
+#   'delete' - the item is mapped, but no longer exists locally
+#   'update' - the remote item differs from the local one; *handler* pushes the fix
+#   'delete_orphan' - a remote item that no local item maps to
+# item_type: one of {'song', 'playlist'}
+# local_id: the local id, or None for orphans
+# gm_id: the remote id, or None for uploads
+# handler: the Handler class to push it with, or None for orphans
+Repair = namedtuple('Repair', ['action', 'item_type', 'local_id', 'gm_id', 'handler'])
+
+#ids read from each table at once
+chunk_size = 5000
+
+#items checked for updates at once
+update_chunk_size = 500
+
+
+def get_remote_library(api, playlist_songs=True):
+    """Return a dict of item_type -> {gmId -> remote item dict} for everything in the library of *api*.
+
+    Playlist dicts have 'id', 'name' and, when *playlist_songs* is True, 'songs': the ordered GM song ids in it.
+    That needs a call per playlist."""
+
+    songs = dict((s['id'], s) for s in api.get_all_songs())
+
+    playlists = {}
+    for name, pids in api.get_all_playlist_ids(auto=False, user=True)['user'].items():
+        #playlists sharing a name are grouped in a list
+        if not isinstance(pids, list):
+            pids = [pids]
+
+        for pid in pids:
+            playlists[pid] = {'id': pid, 'name': name}
+            if playlist_songs:
+                playlists[pid]['songs'] = [s['id'] for s in api.get_playlist_songs(pid)]
+
+    return {'song': songs, 'playlist': playlists}
+
+def iter_sorted(read_chunk):
+    """Yield every row from *read_chunk*, a func taking the last key read (or None at first) and returning
+    the next chunk of rows after it, in key order. Each row's first column is its key. Only one chunk is held at a time."""
+
+    last = None
+    while 1:
+        rows = read_chunk(last)
+        if not rows:
+            return
+
+        for row in rows:
+            yield row
+
+        last = rows[-1][0]
+
+def merge_join(local_ids, mappings):
+    """Yield (localId, exists locally, gmId or None) for every id in either *local_ids* or *mappings*.
+
+    *local_ids* are sorted local ids, and *mappings* sorted (localId, gmId) rows. Neither is held in memory."""
+
+    local_ids = iter(local_ids)
+    mappings = iter(mappings)
+    done = object()
+
+    local_id = next(local_ids, done)
+    mapping = next(mappings, done)
+
+    while local_id is not done or mapping is not done:
+        if mapping is done or (local_id is not done and local_id < mapping[0]):
+            yield local_id, True, None
+            local_id = next(local_ids, done)
+        elif local_id is done or mapping[0] < local_id:
+            yield mapping[0], False, mapping[1]
+            mapping = next(mappings, done)
+        else:
+            yield local_id, True, mapping[1]
+            local_id = next(local_ids, done)
+            mapping = next(mappings, done)
+
+def find_handler(action_pairs, item_type, action):
+    """Return the first handler in *action_pairs* for *item_type* and *action*, or None."""
+    for pair in action_pairs:
+        if pair.handler.item_type == item_type and pair.handler.action == action:
+            return pair.handler
+
+    return None
+
+def plan_repairs(bootstrap_defs, action_pairs, snapshot, ids, remote, log):
+    """Return a list of Repairs that bring the mediaplayer db, the id database and the remote library back in line.
+
+    bootstrap_defs - define the local items of each type, and how to create them
+    action_pairs - the mediaplayer config's action pairs, for the delete and update handlers
+    snapshot - a func taking a func of a mediaplayer cursor, and returning what it returns
+               when called in a read transaction (see SnapshotReader.snapshot)
+    ids - the service's IdDatabase
+    remote - what get_remote_library returned
+
+    Local items and mappings are merge-joined in id order, a chunk at a time, so memory stays bounded
+    by the remote library (which the api returns whole anyway)."""
+
+    repairs = []
+
+    for bdef in bootstrap_defs:
+        create = bdef.handlers[0]
+        item_type = create.item_type
+        delete = find_handler(action_pairs, item_type, 'delete')
+        updates = []
+        for pair in action_pairs:
+            if pair.handler.item_type == item_type and pair.handler.reconciles and pair.handler not in updates:
+                updates.append(pair.handler)
+
+        remote_items = remote[item_type]
+        unreferenced = set(remote_items)
+
+        def check_updates(checks):
+            #read what each update handler needs for a whole chunk of (localId, gmId) at once, then compare
+            local_ids = [local_id for local_id, gm_id in checks]
+            gathered = snapshot(lambda cur: dict((h, h.prefetch(local_ids, cur)) for h in updates))
+
+            for handler in updates:
+                prefetched = gathered[handler]
+                for local_id, gm_id in checks:
+                    if handler.out_of_date(local_id, prefetched.get(local_id), remote_items[gm_id], ids):
+                        repairs.append(Repair('update', item_type, local_id, gm_id, handler))
+
+        local_sql = "SELECT {id_col} FROM {table} WHERE {id_col} > ? ORDER BY {id_col} LIMIT ?".format(**bdef._asdict())
+        local_ids = (row[0] for row in iter_sorted(
+            lambda last: snapshot(lambda cur: cur.execute(local_sql, (last if last is not None else -1, chunk_size)).fetchall())))
+        mappings = iter_sorted(lambda last: ids.get_mappings(item_type, last, chunk_size))
+
+        checks = []
+        for local_id, exists, gm_id in merge_join(local_ids, mappings):
+            if gm_id is None:
+                repairs.append(Repair('upload', item_type, local_id, None, create))
+                continue
+
+            unreferenced.discard(gm_id)
+
+            if not exists:
+                repairs.append(Repair('delete', item_type, local_id, gm_id, delete))
+            elif gm_id not in remote_items:
+                repairs.append(Repair('remap', item_type, local_id, gm_id, create))
+            elif updates:
+                checks.append((local_id, gm_id))
+                if len(checks) >= update_chunk_size:
+                    check_updates(checks)
+                    checks = []
+
+        if checks:
+            check_updates(checks)
+
+        #remote songs the service is keeping for a while after a local delete aren't orphans
+        if item_type == 'song':
+            unreferenced.difference_update(ids.tracked_song_ids())
+
+        for gm_id in sorted(unreferenced):
+            repairs.append(Repair('delete_orphan', item_type, None, gm_id, None))
+
+        log.info("reconciled %ss: %s", item_type,
+                 ', '.join('%s %s' % (len([r for r in repairs if r.item_type == item_type and r.action == action]), action)
+                           for action in ('upload', 'remap', 'delete', 'update', 'delete_orphan')))
+
+    return repairs
+
+def delete_orphans(api, repairs, log):
+    """Delete the remote items of the 'delete_orphan' *repairs* using *api*."""
+    songs = [r.gm_id for r in repairs if r.action == 'delete_orphan' and r.item_type == 'song']
+    playlists = [r.gm_id for r in repairs if r.action == 'delete_orphan' and r.item_type == 'playlist']
+
+    try:
+        if songs:
+            api.delete_songs(songs)
+        for pid in playlists:
+            api.delete_playlist(pid)
+    except CallFailure:
+        log.exception("could not delete orphans")
+        return False
+
+    return True
@@ -4,18 +4,28 @@
 
 import socket
 import logging
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import threading
 import time
-import contextlib
+import itertools
 from functools import partial
 from contextlib import closing
 import os
 import sqlite3
 import json
+import random
 import SocketServer
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 from mpconf import *
+from connections import ConnectionManager
+from ratelimit import LimitedApi
+from metrics import Metrics, format_prometheus
+from profiling import profiler
+from iddb import IdDatabase, create_tables
+from prepare import Preparer
+import reconcile
 from mediamonkey import config as mm_config
 ### Map mediaplayer type to config
 mp_confs = {'mediamonkey': mm_config}
@@ -30,20 +40,24 @@ config_fn = 'config'
 #stores a dict encoding. keys: TODO: formalize the config
 #     db_path: the path of the mediaplayer database
 #     mp_type: the mediaplayer type
+#     email: (optional) the Google Music account to sync to, when one service runs libraries for several accounts
+#     upload_workers: the number of changes from parallel handlers (eg uploads) to push at once
+#     id_cache_size: (optional) the number of local -> GM id mappings to hold in memory
+#     warm_id_cache: (optional) whether to load id mappings into memory on startup
+#     delete_grace: (optional) seconds to keep a song deleted locally before deleting it remotely,
+#                   so it can be reused if the same audio is added again
+#     retry_attempts: (optional) the number of times to try pushing a change before giving up on it
+#     upload_rate: (optional) the most uploads to start per second
+#     call_rate: (optional) the most other api calls (eg metadata and playlist changes) to make per second
+#     upload_max_bytes: (optional) the most bytes of files to upload at once
+#     upload_bandwidth: (optional) the most bytes per second to upload, on average; null for no limit
+#     prepare_cache_bytes: (optional) the most bytes of transcoded songs to keep for re-uploads
+#     prepare_processes: (optional) the number of songs to transcode at once; null for one per core
 #
-change_fn = 'last_change'
+change_fn = 'last_change' #no longer written; the last change id is kept in the id db
 id_db_fn = 'gmids.db'
 log_fn = 'log'
-
-
-#Defines the tables in the id mapping database. Keys are HandlerResult.item_types.
-item_to_table = {'song': 'GMSongIds', 'playlist': 'GMPlaylistIds'}
-
-class UnmappedId(GMSyncError):
-    """Raised when we expect that a mapping exists between local/remote ids,
-    but one does not."""
-    pass
-
+prepared_dir = 'prepared' #transcoded songs are cached in here
 
 ### Utility functions involved in attaching/detaching from the local db.
 
@@ -121,47 +135,6 @@ def reattach(conn, action_pairs):
 
 ### Utilities for writing/reading configuration.
 
-@contextlib.contextmanager
-def backed_up(filename):
-    """Context manager to back up a file and remove the backup.
-
-    *filename*.bak will be overwritten in the process, if it exists.
-    """
-
-    exists = os.path.isfile(filename)
-    bak_name = filename+'.bak'
-
-    if exists: os.rename(filename, bak_name)
-    try:
-        yield
-        #if we terminate unexpectedly (eg a reboot), 
-        # the backup will remain
-    finally:
-        if exists: os.remove(bak_name)
-
-def atomic_write(filename, text):
-    """Return True if *filename* is overwritten with *text* successfully. The write will be atomic.
-
-    *filename*.tmp may be overwritten.
-    """
-
-    tmp_name = filename+'.tmp'
-
-    try:
-        with open(tmp_name, 'w') as tmp:
-            tmp.write(str(text))
-
-        #this _should_ be atomic cross-platform
-        with backed_up(filename):
-            os.rename(tmp_name, filename)            
-
-    except Exception as e:
-        #TODO warn that bak may be able to be restored.
-        return False
-
-
-    return True
-
 def get_conf_dir(confname):
     """Return the directory for this *confname*, with a trailing separator."""
     conf_dir = appdirs.user_data_dir(appname='sync2gm', appauthor='Simon Weber', version=confname)
@@ -182,10 +155,22 @@ def read_config_file(confname):
     with open(get_conf_fn(confname)) as f:
         return json.load(f)
 
+def list_confs():
+    """Return the sorted names of every configuration that's been set up."""
+    root = appdirs.user_data_dir(appname='sync2gm', appauthor='Simon Weber')
+    if not os.path.isdir(root):
+        return []
 
-def init_config(confname, mp_type, mp_db_fn):
+    return sorted(name for name in os.listdir(root) if os.path.isfile(get_conf_fn(name)))
+
+
+def init_config(confname, mp_type, mp_db_fn, upload_workers=4, upload_max_bytes=256 << 20, upload_bandwidth=None, email=None):
     """Attach to the local database, and create or overwrite the configuration for the given *confname*.
     Return True on success, False on failure.
+
+    *upload_max_bytes* bounds the bytes of files uploading at once, and *upload_bandwidth* (if not None)
+    the average bytes per second uploaded. *email* (if not None) names the account to sync to
+    when several libraries are run by one service (see start_services).
     """
 
     conf_dir = get_conf_dir(confname)
@@ -196,61 +181,380 @@ def init_config(confname, mp_type, mp_db_fn):
         os.makedirs(conf_dir)
 
     #(re)create the config file.
-    conf_dict = {'mp_type': mp_type, 'mp_db_fn': mp_db_fn}
+    conf_dict = {'mp_type': mp_type, 'mp_db_fn': mp_db_fn, 'upload_workers': upload_workers,
+                 'upload_max_bytes': upload_max_bytes, 'upload_bandwidth': upload_bandwidth}
+    if email is not None:
+        conf_dict['email'] = email
     write_conf_file(confname, conf_dict)
 
-    #(re)create the change file.
-    with open(conf_dir + change_fn, mode='w') as f:
-        f.write("0")
-
-    #(re)create the id mapping tables.
+    #(re)create the id mapping tables and the change counter.
     with closing(sqlite3.connect(conf_dir + id_db_fn)) as conn:
-        for table in item_to_table.values():
-            conn.executescript("""
-                DROP TABLE IF EXISTS {tablename};
-
-                CREATE TABLE {tablename}(
-                    localId INTEGER PRIMARY KEY,
-                    gmId TEXT NOT NULL);
-                """.format(tablename=table))
-                
+        create_tables(conn)
 
     #(re)attach to the db.
-    action_pairs, make_connection = mp_confs[mp_type]
+    mp_conf = mp_confs[mp_type]
+
+    with closing(mp_conf.make_connection(mp_db_fn)) as conn:
+        return reattach(conn, mp_conf.action_pairs)
+    
+class ChangeWatcher(object):
+    """Waits for changes to an sqlite database by watching the size and mtime of its files.
+
+    This is much cheaper than querying, so we can check often without holding any locks."""
+
+    #sqlite writes these alongside the database, depending on the journal mode
+    suffixes = ('', '-journal', '-wal')
+
+    def __init__(self, db_fn, min_interval=0.05, max_interval=0.5):
+        """Check every *min_interval* seconds at first, backing off to *max_interval* seconds while idle."""
+        self._fns = [db_fn + suffix for suffix in self.suffixes]
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._last = None
+
+    def _signature(self):
+        sig = []
+        for fn in self._fns:
+            try:
+                st = os.stat(fn)
+                sig.append((st.st_size, st.st_mtime))
+            except OSError:
+                sig.append(None)
+
+        return sig
+
+    def mark(self):
+        """Remember the current state of the database. Call this before reading it."""
+        self._last = self._signature()
+
+    def wait(self, wakeup, timeout=None):
+        """Block until the database differs from when mark() was last called, *wakeup* (an Event) is set,
+        or *timeout* seconds pass.
+
+        Return True if the database changed."""
+        interval = self.min_interval
+        deadline = time.time() + timeout if timeout is not None else None
+
+        while not wakeup.is_set():
+            if self._signature() != self._last:
+                return True
+
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                interval = min(interval, remaining)
+
+            wakeup.wait(interval)
+            interval = min(interval * 2, self.max_interval)
+
+        return False
+
+class ChangePruner(object):
+    """Deletes handled rows from sync2gm_Changes, which otherwise grows forever inside the mediaplayer db.
+
+    Rows are deleted a few at a time, each in its own short transaction, so we never hold the
+    mediaplayer's write lock for long. Pruning gives up whenever the lock is busy or new changes arrive."""
+
+    #rows deleted per transaction
+    batch_size = 500
+
+    #seconds between prunes
+    interval = 60
+
+    #milliseconds to wait for the write lock before giving up until next time
+    busy_timeout = 100
+
+    def __init__(self, log):
+        self.log = log
+        self.last_prune = None #time of the last complete prune
+        self.rows = None #rows left in the table after the last complete prune
+        self.pruned = 0 #rows deleted since starting
+
+    @property
+    def since_last_prune(self):
+        """Seconds since the last complete prune, or None if there hasn't been one."""
+        if self.last_prune is None:
+            return None
+        return time.time() - self.last_prune
+
+    def due(self):
+        return self.last_prune is None or self.since_last_prune >= self.interval
+
+    def prune(self, conn, checkpoint, keep_going):
+        """Delete rows at or below *checkpoint* using mediaplayer connection *conn*, while *keep_going()* is True.
+
+        Return True if the prune completed."""
+
+        #don't wait as long as we would for reads; we'll just try again later
+        timeout = conn.execute("PRAGMA busy_timeout").fetchone()[0]
+        conn.execute("PRAGMA busy_timeout = %d" % self.busy_timeout)
+
+        try:
+            while 1:
+                if not keep_going():
+                    return False
+
+                #new changes take priority
+                if conn.execute("SELECT 1 FROM sync2gm_Changes WHERE changeId > ? LIMIT 1", (checkpoint,)).fetchone():
+                    return False
+
+                with conn:
+                    deleted = conn.execute("""DELETE FROM sync2gm_Changes WHERE changeId IN
+                        (SELECT changeId FROM sync2gm_Changes WHERE changeId <= ? ORDER BY changeId LIMIT ?)""",
+                        (checkpoint, self.batch_size)).rowcount
+
+                self.pruned += deleted
+
+                if deleted < self.batch_size:
+                    break
+
+            self.rows = conn.execute("SELECT count(*) FROM sync2gm_Changes").fetchone()[0]
+            self.last_prune = time.time()
+            self.log.debug("pruned changes through id %s; %s rows left", checkpoint, self.rows)
+
+            return True
+
+        except sqlite3.OperationalError as e:
+            if "database is locked" in e.message:
+                self.log.debug("locked - will prune later")
+                return False
+            raise
+
+        finally:
+            conn.execute("PRAGMA busy_timeout = %d" % timeout)
+
+class SnapshotReader(object):
+    """Reads from the mediaplayer db on a connection of its own, backing off while the db is locked.
+
+    This is used for reading changes, and for gathering everything a window of changes needs before pushing it.
+
+    The connection is query-only and sqlite only waits busy_timeout milliseconds for a lock itself, instead of
+    the minute mediaplayer connections wait; after that we back off, doubling from min_backoff up to max_backoff seconds.
+    After max_wait seconds in total the read is given up until the next pass, so the poll thread can get on with
+    everything else. Each read is one short transaction, so we never hold the mediaplayer's lock between reads."""
+
+    busy_timeout = 50
+    min_backoff = 0.01
+    max_backoff = 1.0
+    max_wait = 15
+
+    def __init__(self, make_conn, metrics, log):
+        """*make_conn* - a func taking sqlite3.connect kwargs and returning a mediaplayer connection"""
+        self._conns = ConnectionManager(partial(self._connect, make_conn))
+        self.metrics = metrics
+        self.log = log
+
+    def _connect(self, make_conn):
+        conn = make_conn(check_same_thread=False)
+        conn.isolation_level = None #we begin and end our own transactions
+        conn.execute("PRAGMA busy_timeout = %d" % self.busy_timeout)
+        conn.execute("PRAGMA query_only = 1") #ignored by sqlite before 3.8.0
+        return conn
+
+    def read(self, query, params, stopping):
+        """Return the rows of *query* with *params*, or None if the db stayed locked for max_wait seconds
+        or *stopping* (an Event) was set while waiting."""
+        return self.snapshot(lambda cur: cur.execute(query, params).fetchall(), stopping)
+
+    def snapshot(self, read, stopping):
+        """Return what *read*, a func taking a cursor, returns when called inside one read transaction,
+        or None if the db stayed locked for max_wait seconds or *stopping* (an Event) was set while waiting.
+
+        *read* may be called more than once, so it shouldn't have side effects. Whatever it returns
+        must be plain data, since the transaction is over by the time it's used."""
+        backoff = self.min_backoff
+        start = time.time()
+        locked_until = None #when the read that succeeded began; None if none did
+
+        try:
+            while 1:
+                attempt = time.time()
+                try:
+                    with self._conns.connection() as conn:
+                        with closing(conn.cursor()) as cur:
+                            cur.execute("BEGIN")
+                            try:
+                                rows = read(cur)
+                                locked_until = attempt
+                                return rows
+                            finally:
+                                cur.execute("COMMIT")
+                except sqlite3.OperationalError as e:
+                    if "database is locked" not in e.message:
+                        locked_until = attempt
+                        raise
+
+                self.metrics.inc('lock_retries')
+                waited = time.time() - start
+                if waited >= self.max_wait:
+                    self.log.warning("locked for %.1fs - will read changes later", waited)
+                    return None
+
+                self.log.debug("locked - retrying in %.2fs", backoff)
+                if stopping.wait(min(backoff, self.max_wait - waited) * random.uniform(0.5, 1)):
+                    return None
+                backoff = min(backoff * 2, self.max_backoff)
+
+        finally:
+            #only the failed attempts and backoffs count, not the read itself
+            self.metrics.inc('lock_wait_seconds', n=(locked_until if locked_until is not None else time.time()) - start)
+
+    def close(self):
+        self._conns.close_all()
+
+def coalesce_changes(changes, action_pairs):
+    """Return the changes from *changes* that still need to be pushed, in their original order.
+
+    *changes* is a window of (changeId, changeType, localId) rows, and *action_pairs* is ordered by change type.
+    Per item, repeated updates collapse into the last one, updates covered by a pending create are dropped,
+    and a create followed by a delete cancels out along with everything in between.
+    """
+
+    kept = {} #window position -> change
+    live = {} #(item_type, localId) -> window positions still kept for that item
+
+    for pos, change in enumerate(changes):
+        c_id, c_type, local_id = change
+        handler = action_pairs[c_type].handler
 
-    with closing(make_connection(mp_db_fn)) as conn:
-        return reattach(conn, action_pairs)
+        if handler.item_type is None:
+            kept[pos] = change
+            continue
+
+        positions = live.setdefault((handler.item_type, local_id), [])
+        pending = [action_pairs[kept[p][1]].handler for p in positions]
+        creates = [i for i, h in enumerate(pending) if h.action == 'create']
+
+        if handler.action == 'update':
+            if creates and handler.covered_by_create:
+                continue
+
+            #an earlier update of the same kind is superseded by this one
+            for p, h in zip(positions[:], pending):
+                if h is handler:
+                    del kept[p]
+                    positions.remove(p)
+
+        elif handler.action == 'delete':
+            #anything pending since the last create (or at all, without one) is moot once deleted
+            start = creates[-1] if creates else 0
+            for p in positions[start:]:
+                del kept[p]
+            del positions[start:]
+
+            if creates:
+                continue
+
+        kept[pos] = change
+        positions.append(pos)
+
+    return [kept[pos] for pos in sorted(kept)]
+
+def batch_changes(changes, action_pairs):
+    """Group coalesced *changes* into lists of changes to push together, in the order to push them.
+
+    A change whose handler has a max_batch above 1 joins later changes of the same type,
+    up to max_batch of them, in the place of the first."""
+
+    batches = []
+    open_batches = {} #changeType -> the batch still taking changes of that type
+
+    for change in changes:
+        c_type = change[1]
+        max_batch = action_pairs[c_type].handler.max_batch
+        batch = open_batches.get(c_type)
+
+        if batch is None or len(batch) >= max_batch:
+            batch = []
+            batches.append(batch)
+            if max_batch > 1: open_batches[c_type] = batch
+
+        batch.append(change)
+
+    return batches
     
 class ChangePollThread(threading.Thread):
     """This thread does the work of polling for changes and pushing them out."""
+
+    #The most changes to read (and coalesce) at once.
+    change_window = 500
+
+    #The most items to bootstrap between progress commits.
+    bootstrap_chunk = 100
+
+    #Failed changes are retried after retry_base seconds, doubling each time up to retry_cap, with jitter.
+    #At most retry_chunk of them are pushed between windows of new changes.
+    retry_base = 30
+    retry_cap = 60 * 60
+    retry_chunk = 100
+
+    #At most queue_depth changes per upload worker wait on the pool at once. The poll thread blocks past that,
+    #so a big window (or a pool busy with other libraries) can't queue up more than a shutdown would want to wait for.
+    queue_depth = 2
     
-    def __init__(self, make_conn, api, mp_db_fn, conf_dir, action_pairs):
+    def __init__(self, make_conn, api, mp_db_fn, conf_dir, action_pairs, upload_workers=1, id_cache_size=50000, warm_id_cache=True,
+                 delete_grace=600, retry_attempts=8, prepare_cache_bytes=2 << 30, prepare_processes=None, name=None, uploads=None,
+                 transcodes=None):
         """makeconn - one param func to connect to a db, given a fn
         api - an already authenticated api
         mp_db_fn - filename of the mediaplayer db
         conf_dir - the config dir, with a trailing separator
         action_pairs - a list of action_pairs, ordered by change type
+        upload_workers - the number of threads pushing changes for parallel handlers
+        id_cache_size - the number of local -> GM id mappings to hold in memory
+        warm_id_cache - when True, load id mappings into memory on startup
+        delete_grace - seconds to keep songs deleted locally before deleting them remotely
+        retry_attempts - the number of times to try pushing a change before moving it to the dead letters
+        prepare_cache_bytes - the most bytes of transcoded songs to keep
+        prepare_processes - the number of songs to transcode at once, or None for one per core
+        name - the name of the library, when one service runs several; it names the thread and the logger
+        uploads - a ThreadPool to push parallel handlers on, shared with other libraries; by default we make our own
+        transcodes - a multiprocessing Pool to transcode songs on, shared with other libraries; by default we make our own,
+                     with prepare_processes processes
         """
         
         #Most of this should eventually be pulled into protocol.
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, name=name)
         self._running = threading.Event()
+        self._stopping = threading.Event() #wakes us up when stopped
         self._db = mp_db_fn
-        self.make_conn = partial(make_conn, self._db)
+        self._watcher = ChangeWatcher(self._db)
+        self._pruner = None #needs the logger
+        self._mp_conns = ConnectionManager(partial(make_conn, self._db, check_same_thread=False))
         self._config_dir = conf_dir
-        self._change_file = self._config_dir + change_fn 
 
-
-        id_db_loc = self._config_dir + id_db_fn
-        self.make_gmid_conn = partial(sqlite3.connect, id_db_loc)
+        #Id mappings and the last change id are written here, and committed together.
+        self._ids = IdDatabase(self._config_dir + id_db_fn, id_cache_size)
+        self._ids.upgrade(self._config_dir + change_fn)
+        if warm_id_cache: self._ids.warm()
+        self.delete_grace = delete_grace
+        self.retry_attempts = retry_attempts
 
         self.action_pairs = action_pairs
         self.activate() #we won't run until start()ed
 
         self.api = api
 
-        #Setup logging for the thread.
-        logger = logging.getLogger('sync2gm')
+        #Parallel handlers run here. Id mappings are still updated one at a time.
+        #A shared pool belongs to whoever made it, so we only wait for our own changes on it.
+        self._owns_uploads = uploads is None
+        self._uploads = uploads if uploads is not None else ThreadPool(max(1, upload_workers))
+        self._in_flight = {} #changeId -> (item_type, localId) for changes on the pool
+        self._in_flight_done = threading.Condition()
+        self._max_in_flight = max(1, upload_workers) * self.queue_depth
+        self._cancelled = set() #changeIds dropped from the pool when we were stopped; the checkpoint stays behind them
+
+        #Changes we make up (bootstrapped items and retries) need ids that won't clash with real ones.
+        self._fake_ids = itertools.count(-1, -1)
+
+        #Read by the control socket; none of it needs a database to report.
+        self.metrics = Metrics()
+        self._latest_change = None #the highest changeId seen in sync2gm_Changes
+        self._last_push = None #time of the last successful push
+
+        #Setup logging for the thread. Each library of a service gets its own logger, writing to its own conf dir.
+        logger = logging.getLogger('sync2gm' if name is None else 'sync2gm.' + name)
         logger.setLevel(logging.DEBUG)
 
         # create file handler to log debug info
@@ -262,7 +566,7 @@ class ChangePollThread(threading.Thread):
         ch.setLevel(logging.INFO) #want to make this WARNING later
 
         # create formatter and add it to the handlers
-        formatter = logging.Formatter('%(levelname)s: [%(asctime)s]  %(message)s')
+        formatter = logging.Formatter('%(levelname)s: [%(asctime)s]  ' + ('' if name is None else name + ': ') + '%(message)s')
         fh.setFormatter(formatter)
         ch.setFormatter(formatter)
 
@@ -272,125 +576,658 @@ class ChangePollThread(threading.Thread):
         logger.info("!-- Starting sync2gm log --!")
         self.log = logger
 
+        self._pruner = ChangePruner(self.log)
+        self._preparer = Preparer(conf_dir + prepared_dir + os.sep, self._ids, self.log, prepare_cache_bytes, prepare_processes, transcodes)
+
+        #Reading changes and gathering what they need gets its own connection, so a locked db doesn't hold up anything else.
+        self._reader = SnapshotReader(partial(make_conn, self._db), self.metrics, self.log)
+
         
+    @profiler.timed('get_gm_id')
     def _get_gm_id(self, localId, item_type, cur):
-        """Return the GM id for this *localId* and *item_type*, using sqlite cursor *cur*."""
+        """Return the GM id for this *localId* and *item_type*, or raise UnmappedId.
+
+        *cur* is unused; all lookups go through the shared id database.
+        When called from the poll thread, first wait for any in-flight create of the item."""
+
+        if threading.current_thread() is self:
+            with self._in_flight_done:
+                while (item_type, localId) in self._in_flight.values():
+                    self._in_flight_done.wait()
+
+        return self._ids.get_gm_id(localId, item_type)
 
-        cur.execute("SELECT gmId FROM %s WHERE localId=?" % item_to_table[item_type], (localId,))
-        gm_id = cur.fetchone()
+    @profiler.timed('get_gm_id')
+    def _get_gm_ids(self, local_ids, item_type):
+        """Return a dict mapping each of *local_ids* with a GM id for *item_type* to that id.
 
-        if not gm_id: raise UnmappedId
+        When called from the poll thread, first wait for any in-flight creates of the items."""
 
-        return gm_id[0]                        
+        if threading.current_thread() is self:
+            local_ids = set(local_ids)
+            with self._in_flight_done:
+                while any((i_type == item_type and local_id in local_ids) for i_type, local_id in self._in_flight.values()):
+                    self._in_flight_done.wait()
 
+        return self._ids.get_gm_ids(local_ids, item_type)
 
     def activate(self):
+        self._stopping.clear()
         self._running.set()
 
     def stop(self):
         self._running.clear()
+        self._stopping.set()
+
+        #wake up anything waiting on the pool
+        with self._in_flight_done:
+            self._in_flight_done.notify_all()
 
     @property
     def active(self):
         return self._running.isSet()
 
     def update_id_mapping(self, local_id, handler_res):
-        """Update the local to remote id mapping database with a HandlerResult (*handler_res*)."""
-        action, item_type, gm_id = handler_res
-
-        #two switches for the different events; they're too dissimilar to factor out
-        if action == 'create':
-            command = "REPLACE INTO {table} (localId, gmId) VALUES (?, ?)"
-            values = (local_id, gm_id)
-        elif action == 'delete':
-            command = "DELETE FROM {table} WHERE localId=?"
-            values = (local_id,)
-        else:
-            raise Exception("Unknown HandlerResult.action")
-
-        command = command.format(table=item_to_table[item_type])
+        """Update the local to remote id mapping database with a HandlerResult (*handler_res*).
 
+        This is committed along with the next checkpoint."""
 
         #capture/log failure?
         try:
-            with closing(self.make_gmid_conn()) as conn:
-                with conn: #use context manager to auto-commit
-                    conn.execute(command, values)
-            
+            self._ids.update_mapping(local_id, handler_res)
         except:
             self.log.exception("Problem when updating id mapping")
 
+    def _is_mapped(self, change):
+        """Return True if *change* is a create for an item we already have a mapping for.
+
+        This happens when changes are replayed after a crash, since mappings can be committed ahead of the checkpoint."""
+        c_id, c_type, local_id = change
+        handler = self.action_pairs[c_type].handler
+
+        if handler.action != 'create' or handler.item_type is None:
+            return False
+
+        try:
+            self._ids.get_gm_id(local_id, handler.item_type)
+            return True
+        except UnmappedId:
+            return False
+
+    @profiler.timed('fetch_changes')
+    def _fetch_changes(self, last_change_id):
+        """Return a window of at most self.change_window changes after *last_change_id*,
+        or None if the mediaplayer db is too busy to read right now."""
+
+        window = self._reader.read("SELECT changeId, changeType, localId FROM sync2gm_Changes WHERE changeId > ? ORDER BY changeId LIMIT ?",
+                                   (last_change_id, self.change_window), self._stopping)
+        if window is None:
+            return None
+
+        #a full window means there's more behind it; max() on the primary key is just an index lookup
+        if len(window) == self.change_window:
+            latest = self._reader.read("SELECT max(changeId) FROM sync2gm_Changes", (), self._stopping)
+            if latest is not None:
+                self._latest_change = latest[0][0]
+        else:
+            self._latest_change = window[-1][0] if window else last_change_id
+
+        return window
+
+    @profiler.timed('gather')
+    def _gather(self, changes):
+        """Return a dict mapping each handler of *changes* to what its prefetch returned for them,
+        or None if the mediaplayer db is too busy to read right now.
+
+        Everything is read in one short read transaction, so nothing holds the mediaplayer's locks while pushing."""
+        local_ids = {} #handler -> local ids
+        for c_id, c_type, local_id in changes:
+            local_ids.setdefault(self.action_pairs[c_type].handler, set()).add(local_id)
+
+        if not local_ids:
+            return {}
+
+        gathered = self._reader.snapshot(lambda cur: dict((handler, handler.prefetch(list(ids), cur)) for handler, ids in local_ids.items()),
+                                         self._stopping)
+
+        #eg start transcoding songs, while earlier changes are pushed
+        if gathered is not None:
+            for handler, prefetched in gathered.items():
+                handler.prepare_ahead(prefetched, self._preparer)
+
+        return gathered
+
+    def _snapshot(self, read):
+        """Return what *read*, a func taking a mediaplayer cursor, returns in one read transaction, or raise GMSyncError."""
+        res = self._reader.snapshot(read, self._stopping)
+        if res is None:
+            raise GMSyncError("the mediaplayer db is locked, or the service is stopping")
+
+        return res
+
+    def _change_type(self, handler):
+        """Return the first change type pushed by *handler*."""
+        return [i for i, pair in enumerate(self.action_pairs) if pair.handler is handler][0]
+
+    def _handle_batch(self, batch, prefetched):
+        """Push out a *batch* of changes of one type.
+
+        *prefetched* is what the handler's prefetch returned for these changes; no mediaplayer connection is used.
+        A batch that fails is split in half and retried, until the failure is narrowed down to a single change."""
+        c_type = batch[0][1]
+        local_ids = [local_id for _, _, local_id in batch]
+        self.log.info("==== handling change ids %s", ', '.join(str(c_id) for c_id, _, _ in batch))
+
+        try:
+            #Create Handlers per the mp_conf specs, then use them to push our changes.
+            pair = self.action_pairs[c_type]
+            self.log.info("handler name: %s", pair.handler.__name__)
+            self.log.info("local ids: %s", local_ids)
+
+            with profiler.sample(pair.handler.__name__):
+                gmid_conn = self._ids.conn
+                handlers = [pair.handler(local_id, self.api, None, gmid_conn, self._get_gm_id, self.log, self._get_gm_ids, self._ids, self._preparer)
+                            for local_id in local_ids]
+
+                for h in handlers: h.prefetched = prefetched.get(h.local_id)
+
+                start = time.time()
+                with profiler.phase('push_changes'):
+                    results = pair.handler.push_batch(handlers)
+                self.metrics.observe('handler_latency', time.time() - start, pair.handler.__name__)
+
+                #When a handler created a remote object, update our local mappings.
+                with profiler.phase('update_mapping'):
+                    for local_id, res in zip(local_ids, results):
+                        if res is not None: self.update_id_mapping(local_id, res)
+
+                    self._ids.clear_retries(batch)
+
+            self.metrics.inc('changes_handled', pair.handler.__name__, len(batch))
+            self._last_push = time.time()
+
+        except (CallFailure, UnmappedId) as e:
+            if len(batch) > 1:
+                self.log.info("batch of %s failed - splitting", len(batch))
+                mid = len(batch) // 2
+                self._handle_batch(batch[:mid], prefetched)
+                self._handle_batch(batch[mid:], prefetched)
+            elif isinstance(e, UnmappedId) and self._drop_uncreated(batch[0]):
+                self.log.info("change %s deletes an item with no mapping - dropped it", batch[0])
+            else:
+                #An unmapped id is often an item whose create is waiting to be retried.
+                self.metrics.inc('changes_failed', self.action_pairs[c_type].handler.__name__)
+                self._retry_later(batch[0], e)
+        except LocalOutdated:
+            self.log.info('local outdated - change skipped. this should be safe')
+            self._ids.clear_retries(batch)
+        except Exception as e:
+            #for debugging
+            self.metrics.inc('changes_failed', self.action_pairs[c_type].handler.__name__, len(batch))
+            self.log.exception("exception while pushing change")
+
+            #retried like any other failure, so a change that always fails ends up in the dead letters
+            for change in batch:
+                self._retry_later(change, e)
+
+    def _drop_uncreated(self, change):
+        """If *change* is a delete of an item we have no mapping for, drop it and any queued retry of the item's create,
+        and return True.
+
+        Either the item was never created, or this delete was already pushed: mappings can be committed ahead of
+        the checkpoint (eg by retries, or the group commit), so it's replayed after a crash."""
+        c_id, c_type, local_id = change
+        handler = self.action_pairs[c_type].handler
+        if handler.action != 'delete' or handler.item_type is None:
+            return False
+
+        try:
+            self._get_gm_id(local_id, handler.item_type, None)
+            return False
+        except UnmappedId:
+            pass
+
+        creates = [(c_id, i, local_id) for i, pair in enumerate(self.action_pairs)
+                   if pair.handler.item_type == handler.item_type and pair.handler.action == 'create']
+        self._ids.clear_retries(creates + [change])
+        return True
+
+    def _retry_later(self, change, error):
+        """Queue *change*, which failed with *error*, to be pushed again after a backoff, or give up on it after too many attempts.
+
+        This is committed along with the next checkpoint."""
+        change = tuple(change)
+        attempts = self._ids.retry_attempts(change) + 1
+        error = repr(error)
+
+        try:
+            if attempts >= self.retry_attempts:
+                self.log.error("change %s failed %s times (%s) - moved to dead letters", change, attempts, error)
+                self._ids.dead_letter(change, attempts, error)
+            else:
+                delay = min(self.retry_cap, self.retry_base * 2 ** (attempts - 1)) * random.uniform(0.5, 1.5)
+                self.log.warning("change %s failed (%s) - retrying in %.0fs", change, error, delay)
+                self._ids.schedule_retry(change, attempts, time.time() + delay, error)
+        except sqlite3.Error:
+            self.log.exception("could not queue change %s for retry - it will not be pushed", change)
+
+    def _handle_retries(self):
+        """Push out queued retries that are due.
+
+        Retries on the worker pool aren't waited for, so they don't hold up new changes."""
+        try:
+            retries = self._ids.take_due_retries(self.retry_chunk, self.retry_cap)
+        except sqlite3.Error:
+            #don't roll back; the open transaction holds mappings of pushes that already succeeded
+            self.log.exception("could not read the retry queue")
+            return
+
+        if not retries:
+            return
+
+        self.log.info("retrying %s changes", len(retries))
+
+        gathered = self._gather(retries)
+        if gathered is None:
+            #put them back, rather than leave them until their lease runs out
+            self._ids.release_retries(retries, time.time() + self.retry_base)
+            self._ids.commit()
+            return
+
+        #Retries are all behind the checkpoint; fake ids keep them out of its way.
+        retries = [(next(self._fake_ids), c_type, local_id) for c_id, c_type, local_id in retries]
+
+        self._push_batches(batch_changes(retries, self.action_pairs), gathered)
+
+        self._ids.commit()
+
+    def _push_batches(self, batches, gathered):
+        """Push out *batches*, with what _gather returned for them, without waiting for those on the worker pool."""
+        for batch in batches:
+            handler = self.action_pairs[batch[0][1]].handler
+            if handler.parallel:
+                self._submit_upload(batch, gathered.get(handler, {}))
+            else:
+                self._handle_batch(batch, gathered.get(handler, {}))
+
+    def _submit_upload(self, batch, prefetched):
+        """Push out a *batch* of changes for a parallel handler on the worker pool."""
+        item_type = self.action_pairs[batch[0][1]].handler.item_type
+
+        with self._in_flight_done:
+            while self._in_flight and len(self._in_flight) + len(batch) > self._max_in_flight and self.active:
+                self._in_flight_done.wait()
+
+            for c_id, c_type, local_id in batch:
+                self._in_flight[c_id] = (item_type, local_id)
+
+        self._uploads.apply_async(self._run_upload, (batch, prefetched))
+
+    def _run_upload(self, batch, prefetched):
+        try:
+            if not self.active:
+                #Once we're stopped, changes still queued are left for next time, so shutdown needn't wait for them.
+                #Retries come back when their lease runs out.
+                with self._in_flight_done:
+                    self._cancelled.update(c_id for c_id, c_type, local_id in batch)
+                return
+
+            with profiler.cprofiled():
+                self._handle_batch(batch, prefetched)
+        except:
+            self.log.exception("exception on the worker pool")
+        finally:
+            with self._in_flight_done:
+                for c_id, c_type, local_id in batch:
+                    del self._in_flight[c_id]
+                self._in_flight_done.notify_all()
+
+    def _wait_for_upload(self, min_id=None):
+        """Block until a change on the worker pool finishes, if any are in flight. Return True if any were.
+
+        When *min_id* is given, only changes with ids from there on count."""
+        with self._in_flight_done:
+            if not any(min_id is None or c_id >= min_id for c_id in self._in_flight):
+                return False
+            self._in_flight_done.wait()
+            return True
+
+    def _advance_checkpoint(self, window_ids, unhandled_ids, last_change_id):
+        """Commit the checkpoint as far into *window_ids* as it can go, and return it.
+
+        It stops before any change in *unhandled_ids* or still in flight; everything else in the window
+        is marked as handled, correctly or not. Changes collapsed into a later one are only marked once that one is pushed."""
+
+        with self._in_flight_done:
+            #retries in flight are already behind the checkpoint
+            remaining = [c_id for c_id in itertools.chain(self._in_flight, self._cancelled) if c_id > last_change_id]
+        remaining.extend(unhandled_ids)
+
+        if remaining:
+            next_id = min(remaining)
+            checkpoint = max([c_id for c_id in window_ids if c_id < next_id] or [last_change_id])
+        else:
+            checkpoint = window_ids[-1]
+
+        if checkpoint != last_change_id:
+            try:
+                self._ids.commit_checkpoint(checkpoint)
+            except sqlite3.Error:
+                #Rolling back would throw away mappings of pushes that already succeeded, and replaying those
+                #would upload duplicates. They stay pending, and the commit is retried with the next checkpoint.
+                self.log.exception("failed to commit change id %s - will retry", checkpoint)
+                return last_change_id
+
+        return checkpoint
+
+    def _delete_expired_songs(self):
+        """Delete songs remotely that were deleted locally more than delete_grace seconds ago, and never came back.
+
+        Uploads on the worker pool can't claim them while they're being deleted."""
+        gm_ids = self._ids.take_expired_songs(self.delete_grace)
+
+        if gm_ids:
+            self.log.info("deleting %s expired songs", len(gm_ids))
+            try:
+                self.api.delete_songs(gm_ids)
+                self._ids.drop_song_hashes(gm_ids)
+                self._ids.commit()
+            except CallFailure:
+                self.log.error('call failure from api - expired songs will be deleted later')
+            finally:
+                self._ids.release_expired_songs(gm_ids)
+
+    def _handle_window(self, window, last_change_id):
+        """Push out a *window* of changes, and return the new last change id."""
+        window_ids = [c_id for c_id, c_type, local_id in window]
+
+        changes = [change for change in window if not self._is_mapped(change)]
+        changes = coalesce_changes(changes, self.action_pairs)
+
+        #Deletes are replayed too, eg when a stop left uploads before them queued. Once coalesced, one left
+        #without a mapping has no create before it in the window, so it was already pushed (or never needed to be).
+        changes = [change for change in changes if not self._drop_uncreated(change)]
+        batches = batch_changes(changes, self.action_pairs)
+        self.log.info("coalesced %s changes into %s in %s batches", len(window), len(changes), len(batches))
+
+        gathered = self._gather(changes)
+        if gathered is None:
+            self.log.info("too busy to gather changes - will try again")
+            return last_change_id
+
+        for i, batch in enumerate(batches):
+            if not self.active:
+                #the rest are left for next time; the checkpoint stays behind them
+                unhandled_ids = [c_id for b in batches[i:] for c_id, c_type, local_id in b]
+                return self._advance_checkpoint(window_ids, unhandled_ids, last_change_id)
+
+            self._push_batches([batch], gathered)
+
+            unhandled_ids = [c_id for b in batches[i + 1:] for c_id, c_type, local_id in b]
+            last_change_id = self._advance_checkpoint(window_ids, unhandled_ids, last_change_id)
+
+        while self._wait_for_upload(window_ids[0]):
+            last_change_id = self._advance_checkpoint(window_ids, [], last_change_id)
+
+        return self._advance_checkpoint(window_ids, [], last_change_id)
+
     def run(self):
 
-        read_new_changeid = True #assumes a change file exists
+        last_change_id = self._ids.get_checkpoint()
 
         while self.active:
+            self._watcher.mark()
+
+            try:
+                with profiler.cprofiled():
+                    self._handle_retries()
+
+                    window = self._fetch_changes(last_change_id)
+
+                    if window:
+                        last_change_id = self._handle_window(window, last_change_id)
+
+                    elif window is not None and self._pruner.due():
+                        #We're idle, so clean up after ourselves.
+                        #Connections are kept between passes, and reconnected after an sqlite error.
+                        with self._mp_conns.connection() as conn:
+                            self._pruner.prune(conn, last_change_id, lambda: self.active)
+                        self._delete_expired_songs()
+
+            except sqlite3.Error:
+                self.log.exception("problem reading changes - reconnecting")
+                self._stopping.wait(1)
+                continue
+
+            #Keep draining while there's a backlog, then sleep until the db changes or a retry is due.
+            #Dead letters can be replayed behind our back, so the retry queue is checked now and then regardless.
+            if not window:
+                try:
+                    next_retry = self._ids.next_retry_at()
+                except sqlite3.Error:
+                    next_retry = None
+                timeout = self.retry_base if next_retry is None else min(max(0, next_retry - time.time()), self.retry_base)
+                if window is None:
+                    #the db was locked; a reader holding it won't change the files
+                    timeout = min(timeout, self._reader.max_backoff)
+                self._watcher.wait(self._stopping, timeout)
+
+        self.close()
+
+    def stats(self):
+        """Return a dict of the backlog, throughput and latency of this thread, and of its api if it's rate limited."""
+        checkpoint = self._ids.get_checkpoint()
+        latest = self._latest_change
+
+        with self._in_flight_done:
+            in_flight = len(self._in_flight)
+
+        return {'pending_changes': max(0, latest - checkpoint) if latest is not None else None,
+                'last_change_id': checkpoint,
+                'in_flight': in_flight,
+                'since_last_push': round(time.time() - self._last_push, 3) if self._last_push is not None else None,
+                'lock_retries': self.metrics.count('lock_retries'),
+                'lock_wait_seconds': round(self.metrics.count('lock_wait_seconds'), 3),
+                'id_cache_hits': self._ids.cache.hits,
+                'id_cache_misses': self._ids.cache.misses,
+                'id_cache_items': len(self._ids.cache),
+                'changes_table_rows': self._pruner.rows,
+                'changes_pruned': self._pruner.pruned,
+                'since_last_prune': round(self._pruner.since_last_prune, 3) if self._pruner.last_prune is not None else None,
+                'changes_handled': self.metrics.counters('changes_handled'),
+                'changes_failed': self.metrics.counters('changes_failed'),
+                'handler_latency': self.metrics.histograms('handler_latency'),
+                'api': self.api.stats() if isinstance(self.api, LimitedApi) else {}}
+
+    def start_cprofile(self, seconds):
+        """Run cProfile on this thread and its workers for *seconds* seconds, and return the prefix of the files it's dumped to."""
+        prefix = self._config_dir + time.strftime('profile-%Y%m%d-%H%M%S')
+        profiler.start_cprofile(seconds, prefix)
+        return prefix
+
+    def close(self):
+        """Wait for the worker pool, then close our connections. run() calls this when stopped."""
+        if self._owns_uploads:
+            self._uploads.close()
+            self._uploads.join()
+        else:
+            while self._wait_for_upload():
+                pass
+        self._preparer.close()
 
-            if read_new_changeid:
-               with open(self._change_file) as f:
-                   last_change_id = int(f.readline().strip())
-                   
-            #Buffer in changes to memory.
-            #The limit is intended to limit risk of losing changes.
-            max_changes = 10
+        #keep the mappings of pushes that finished since the last checkpoint, so they aren't pushed again
+        try:
+            self._ids.commit()
+        except sqlite3.Error:
+            self.log.exception("could not commit the last mappings")
+
+        self._reader.close()
+        self._mp_conns.close_all()
+        self._ids.close()
 
-            #opening a new conn every time - not sure if this is desirable
-            with closing(self.make_conn()) as conn, closing(conn.cursor()) as cur:
-            
-                #continue to retry while db is locked
-                while 1:
-                    try:
-                        cur.execute("SELECT changeId, changeType, localId FROM sync2gm_Changes WHERE changeId > ?", (last_change_id,))
-                        break
-                    except sqlite3.Error as e:
-                        if "database is locked" in e.message:
-                            self.log.info("locked - retrying")
-                        else: raise
-                    
-                changes = cur.fetchmany(max_changes)
-
-                if len(changes) is 0:
-                    read_new_changeid = False
-                else:
-                    read_new_changeid = True
-
-                    for change in changes:
-                        c_id, c_type, local_id = change
-                        self.log.info("==== handling change id %s", c_id)
-                        
-                        try:
-                            #Create a Handler per the mp_conf specs, then use it to push our changes.
-                            pair = self.action_pairs[c_type]
-                            self.log.info("handler name: %s", pair.handler.__name__)
-                            self.log.info("local id: %s", local_id)
-
-                            handler = pair.handler(local_id, self.api, conn, self.make_gmid_conn(), self._get_gm_id, self.log) #TODO: is gmid_conn getting closed?
-                            res = handler.push_changes()
-
-                            #When the handler created a remote object, update our local mappings.
-                            if res is not None: self.update_id_mapping(local_id, res)
-
-                        except CallFailure as cf:
-                            self.log.error('call failure from api - change may not be pushed')
-                        except UnmappedId:
-                            self.log.error('unmapped id - could not push this change')
-                        except LocalOutdated:
-                            self.log.info('local outdated - change skipped. this should be safe')
-                        except Exception as e:
-                            #for debugging
-                            self.log.exception("exception while pushing change")
-
-                        finally: #mark this change as handled, correctly or not
-                            if not atomic_write(self._change_file, c_id):
-                                self.log.error("failed to write id %s to change file", c_id) 
-                                #TODO: getting an error here when the log file gets locked in Windows?
-
-                            
-
-                        
-        
-            
-            time.sleep(5) 
+    def bootstrap(self, bootstrap_defs):
+        """Push every item already in the mediaplayer db, as defined by *bootstrap_defs*, then hand off to the change stream.
+
+        Call this instead of start(), on an attached db. Chunks of items are pushed like windows of changes, and progress
+        is committed once a chunk's pushes on the worker pool finish, so an interrupted bootstrap resumes where it stopped.
+        Each table's pushes finish before the next table starts, since its items may refer to them (eg playlists to songs).
+        Changes logged since it first started are replayed afterwards; replayed creates of items it already pushed are skipped."""
+
+        conn = self._mp_conns.get()
+
+        #Changes up to here are covered by the bootstrap.
+        handoff = self._ids.get_state('bootstrap_handoff')
+        if handoff is None:
+            (handoff,) = conn.execute("SELECT coalesce(max(changeId), 0) FROM sync2gm_Changes").fetchone()
+            self._ids.set_state('bootstrap_handoff', handoff)
+            self._ids.commit()
+
+        for bdef in bootstrap_defs:
+            progress_name = 'bootstrap:' + bdef.table
+            last_id = self._ids.get_state(progress_name, -1)
+            self.log.info("bootstrapping %s after id %s", bdef.table, last_id)
+
+            pushed = [] #(last local id, changeIds) of the chunks pushed since progress was last committed, in order
+
+            while self.active:
+                with closing(conn.cursor()) as cur:
+                    chunk = [row[0] for row in cur.execute("SELECT {id_col} FROM {table} WHERE {id_col} > ? ORDER BY {id_col} LIMIT ?".format(**bdef._asdict()),
+                                                           (last_id, self.bootstrap_chunk))]
+                if not chunk:
+                    break
+
+                changes = []
+                for handler in bdef.handlers:
+                    c_type = self._change_type(handler)
+                    local_ids = chunk
+
+                    if handler.action == 'create':
+                        mapped = self._ids.get_gm_ids(chunk, handler.item_type)
+                        local_ids = [local_id for local_id in chunk if local_id not in mapped]
+
+                    changes.extend((next(self._fake_ids), c_type, local_id) for local_id in local_ids)
+
+                gathered = self._gather(changes)
+                if gathered is None:
+                    continue #locked, or stopping
+
+                #uploads aren't waited for here, so the pool stays busy across chunks
+                self._push_batches(batch_changes(changes, self.action_pairs), gathered)
+                pushed.append((chunk[-1], set(c_id for c_id, c_type, local_id in changes)))
+                last_id = chunk[-1]
+
+                self._bootstrap_progress(bdef, pushed)
+
+            while self._wait_for_upload():
+                pass
+            self._bootstrap_progress(bdef, pushed)
+
+        if not self.active:
+            self.log.info("bootstrap stopped; it will resume from here")
+            return False
+
+        self._ids.set_state('last_change', max(self._ids.get_checkpoint(), handoff))
+        self._ids.del_state('bootstrap_handoff')
+        for bdef in bootstrap_defs:
+            self._ids.del_state('bootstrap:' + bdef.table)
+        self._ids.commit()
+
+        self.log.info("bootstrap finished; changes will be handled from id %s", handoff)
+        return True
+
+    def _bootstrap_progress(self, bdef, pushed):
+        """Commit the bootstrap progress of *bdef* through the chunks at the start of *pushed* (see bootstrap)
+        whose changes have all left the worker pool, and drop them from it.
+
+        A chunk with changes dropped from the pool when we were stopped is never passed, so they're pushed on resuming."""
+        with self._in_flight_done:
+            busy = set(self._in_flight) | self._cancelled
+
+        last_id = None
+        while pushed and not busy.intersection(pushed[0][1]):
+            last_id = pushed.pop(0)[0]
+
+        if last_id is not None:
+            self._ids.set_state('bootstrap:' + bdef.table, last_id)
+            self._ids.commit()
+            self.log.info("bootstrapped %s through id %s", bdef.table, last_id)
+
+    def reconcile(self, bootstrap_defs, execute=False, delete_orphans=False):
+        """Compare the mediaplayer db, the id mappings and the remote library, and return a list of the Repairs
+        that bring them back in line. Local items are those defined by *bootstrap_defs*.
+
+        When *execute* is True, the repairs are also pushed through the handlers, like changes. Remote items no
+        local item maps to are only deleted if *delete_orphans* is True too, since they may not have come from here.
+        Like bootstrap, call this instead of start()."""
+
+        self.log.info("reading the remote library")
+        remote = reconcile.get_remote_library(self.api)
+
+        repairs = reconcile.plan_repairs(bootstrap_defs, self.action_pairs, self._snapshot, self._ids, remote, self.log)
+
+        if execute:
+            self._repair(bootstrap_defs, repairs, delete_orphans)
+
+        return repairs
+
+    def _repair(self, bootstrap_defs, repairs, delete_orphans):
+        """Push out *repairs* from reconcile."""
+
+        #Items whose remote copy is gone are unmapped, so they're created again; their audio can't be reused.
+        #Items that drifted are pushed in full, rather than diffed against what we think we pushed.
+        for r in repairs:
+            if r.action == 'remap':
+                self._ids.update_mapping(r.local_id, HandlerResult(action='delete', item_type=r.item_type, gm_id=r.gm_id))
+                if r.item_type == 'song': self._ids.drop_song_hashes([r.gm_id])
+            elif r.action == 'update':
+                self._ids.forget_pushed(r.item_type, [r.local_id])
+
+        #Playlists holding a remapped song still point at its old GM id, so they're replaced in full next time.
+        remapped = [r.gm_id for r in repairs if r.action == 'remap' and r.item_type == 'song']
+        self._ids.forget_pushed('playlist', self._ids.playlists_with_songs(remapped))
+        self._ids.commit()
+
+        for bdef in bootstrap_defs:
+            item_type = bdef.handlers[0].item_type
+            created = [r.local_id for r in repairs if r.item_type == item_type and r.action in ('upload', 'remap')]
+
+            #items are created the same way bootstrap creates them, eg playlists are created then filled
+            steps = [(handler, created) for handler in bdef.handlers]
+            steps.append((reconcile.find_handler(self.action_pairs, item_type, 'delete'),
+                          [r.local_id for r in repairs if r.item_type == item_type and r.action == 'delete']))
+
+            updates = OrderedDict() #handler -> local ids
+            for r in repairs:
+                if r.item_type == item_type and r.action == 'update':
+                    updates.setdefault(r.handler, []).append(r.local_id)
+            steps.extend(updates.items())
+
+            for handler, local_ids in steps:
+                self._push_repairs(handler, local_ids)
+
+        if delete_orphans:
+            reconcile.delete_orphans(self.api, repairs, self.log)
+
+        self.log.info("pushed %s repairs", len(repairs))
+
+    def _push_repairs(self, handler, local_ids):
+        """Push out *local_ids* with *handler* as if each had just changed, a chunk at a time."""
+        c_type = self._change_type(handler)
+        changes = [(next(self._fake_ids), c_type, local_id) for local_id in local_ids]
+
+        for i in range(0, len(changes), self.bootstrap_chunk):
+            if not self.active:
+                return
+
+            chunk = changes[i:i + self.bootstrap_chunk]
+            gathered = self._gather(chunk)
+            if gathered is None:
+                raise GMSyncError("the mediaplayer db is locked, or the service is stopping")
+
+            self._push_batches(batch_changes(chunk, self.action_pairs), gathered)
+            while self._wait_for_upload():
+                pass
+            self._ids.commit()
 
 
 
@@ -398,28 +1235,92 @@ class ChangePollThread(threading.Thread):
 class ServiceHandler(SocketServer.StreamRequestHandler):
     """Respond if we are running, and handle shutdown requests.
 
-    valid requests are: 'shutdown' and 'status'. 
+    valid requests are: 'shutdown', 'status', 'libraries', 'limits', 'stats' and 'stats prometheus'.
+
+    'status' receives a response 'running'.
+    'libraries' receives a json list of the names of the libraries the service is running.
+    'limits' receives a json dict of the current api rates and throttle counts, per lane.
+    'stats' receives a json dict of backlog, throughput and latency (see ChangePollThread.stats),
+    and 'stats prometheus' the same in the Prometheus text format.
+
+    'profile' receives a json dict of the sampled timing breakdown (see Profiler.stats). It can be followed by
+    'rate <fraction>' to set the fraction of changes sampled (0 turns it off), 'reset' to clear the timings,
+    or 'cprofile <seconds>' to run cProfile for a while; the response then has the prefix of the dump files.
+
+    'shutdown' only asks the service to stop; it's carried out by the thread started with the service (see _supervise),
+    since stopping the server from one of its own requests would never return.
 
-    'status' receieves a response 'running'."""
+    A request can be addressed to one library by starting it with '@<name> ', eg '@jazz stats';
+    '@<name> shutdown' stops only that library, and the service once none are left. Otherwise, when the service runs several libraries,
+    'limits' and 'stats' receive a dict of each library's response, keyed by name, and Prometheus
+    samples are labelled with library="<name>"."""
+
+    def _respond(self, targets, f):
+        #one library's response as is, or every library's keyed by name
+        if len(targets) == 1:
+            return f(targets.values()[0])
+        return dict((name, f(t)) for name, t in targets.items())
 
     def handle(self):
         self.data = self.rfile.readline().strip()
+        libraries = self.server.libraries
+
+        name = None
+        if self.data.startswith('@'):
+            name, _, self.data = self.data[1:].partition(' ')
+            if name not in libraries:
+                self.wfile.write(json.dumps({'error': 'no library named %s' % name}))
+                return
+
+        targets = OrderedDict([(name, libraries[name])]) if name is not None else libraries
 
         if self.data == 'shutdown':
-            for t in threading.enumerate():
-                if isinstance(t, ChangePollThread):
-                    t.stop()
-                    t.join()
+            if name is not None:
+                #it closes itself once its pushes in progress finish
+                libraries.pop(name).stop()
+                if libraries:
+                    return
 
-            self.server.shutdown()
+            self.server.stopping.set()
 
         elif self.data == 'status':
             self.wfile.write('running')
 
+        elif self.data == 'libraries':
+            self.wfile.write(json.dumps(libraries.keys()))
+
+        elif not targets:
+            self.wfile.write(json.dumps({}))
+
+        elif self.data == 'limits':
+            self.wfile.write(json.dumps(self._respond(targets, lambda t: t.api.stats() if isinstance(t.api, LimitedApi) else {})))
+
+        elif self.data in ('stats', 'stats prometheus'):
+            stats = self._respond(targets, lambda t: t.stats())
+            if self.data == 'stats prometheus':
+                self.wfile.write(format_prometheus(stats, by_library=len(targets) > 1))
+            else:
+                self.wfile.write(json.dumps(stats))
+
+        elif self.data.split(' ')[0] == 'profile':
+            args = self.data.split(' ')[1:]
+            response = {}
+
+            #timings are kept for the whole process; cProfile dumps go in the first (or addressed) library's conf dir
+            if args[:1] == ['rate']:
+                profiler.set_sample_rate(args[1])
+            elif args[:1] == ['reset']:
+                profiler.reset()
+            elif args[:1] == ['cprofile']:
+                response['cprofile_prefix'] = targets.values()[0].start_cprofile(float(args[1]))
+
+            response.update(profiler.stats())
+            self.wfile.write(json.dumps(response))
+
 def send_service(port, s, receive=False):
     """Send a string *s* to the service running on port *port*.
     
-    When *receieve* is True, return the service's response."""
+    When *receive* is True, return the service's response."""
 
   # Create a socket (SOCK_STREAM means a TCP socket)
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -429,13 +1330,17 @@ def send_service(port, s, receive=False):
         sock.connect(('localhost', port))
         sock.sendall(s + "\n")
 
-        if recieve:
-            # Receive data from the server and shut down
-            received = sock.recv(1024)
+        if receive:
+            # Receive data until the server hangs up
+            received = []
+            data = sock.recv(4096)
+            while data:
+                received.append(data)
+                data = sock.recv(4096)
     finally:
             sock.close()
 
-    if receieve: return received
+    if receive: return ''.join(received)
    
 
 def is_service_running(port):
@@ -445,29 +1350,238 @@ def is_service_running(port):
     except:
         return False
 
-def stop_service(port):
-    """Send a signal to stop the service on port *port*."""
-    if is_service_running(port): send_service(port, 'shutdown')
+def _addressed(s, library):
+    return s if library is None else '@%s %s' % (library, s)
+
+def stop_service(port, library=None):
+    """Send a signal to stop the service on port *port*, or only its *library*."""
+    if is_service_running(port): send_service(port, _addressed('shutdown', library))
+
+def service_libraries(port):
+    """Return the names of the libraries run by the service on port *port*."""
+    return json.loads(send_service(port, 'libraries', receive=True))
+
+def service_limits(port, library=None):
+    """Return the api rate limits of the service on port *port*, as a dict mapping each lane to its stats.
+
+    When the service runs several libraries, give the *library* to ask about, or get a dict of each library's limits."""
+    return json.loads(send_service(port, _addressed('limits', library), receive=True))
+
+def service_stats(port, prometheus=False, library=None):
+    """Return the stats of the service on port *port*, as a dict, or as Prometheus text when *prometheus* is True.
+
+    When the service runs several libraries, give the *library* to ask about, or get a dict of each library's stats."""
+    if prometheus:
+        return send_service(port, _addressed('stats prometheus', library), receive=True)
+
+    return json.loads(send_service(port, _addressed('stats', library), receive=True))
+
+def service_profile(port, rate=None, reset=False, cprofile=None, library=None):
+    """Return the sampled timing breakdown of the service on port *port*, as a dict.
+
+    First set the sample *rate*, *reset* the timings, or run cProfile for *cprofile* seconds, if given.
+    Timings cover every library of the service; cProfile dumps go to the conf dir of *library*, or the first one."""
+    if rate is not None:
+        send_service(port, 'profile rate %s' % rate, receive=True)
+    if reset:
+        send_service(port, 'profile reset', receive=True)
+    if cprofile is not None:
+        return json.loads(send_service(port, _addressed('profile cprofile %s' % cprofile, library), receive=True))
+
+    return json.loads(send_service(port, 'profile', receive=True))
+
+def make_limited_api(api, conf):
+    """Return authenticated *api* wrapped in a LimitedApi, paced according to config dict *conf*."""
+    return LimitedApi(api,
+                      upload_rate=conf.get('upload_rate', 1.0),
+                      call_rate=conf.get('call_rate', 5.0),
+                      upload_concurrency=max(1, conf.get('upload_workers', 1)),
+                      upload_max_bytes=conf.get('upload_max_bytes', 256 << 20),
+                      upload_bandwidth=conf.get('upload_bandwidth'))
+
+def make_poll_thread(confname, conf, api, uploads=None, transcodes=None, name=None):
+    """Return a ChangePollThread for config *confname*, with config dict *conf* and authenticated *api*.
+
+    Calls to *api* are paced according to the config, unless it's already a LimitedApi (eg one shared between libraries).
+    *uploads*, *transcodes* and *name* are passed on to the thread."""
+    mp_conf = mp_confs[conf['mp_type']]
+    if not isinstance(api, LimitedApi):
+        api = make_limited_api(api, conf)
+
+    return ChangePollThread(mp_conf.make_connection, api, conf['mp_db_fn'], get_conf_dir(confname), mp_conf.action_pairs,
+                            upload_workers=conf.get('upload_workers', 1),
+                            id_cache_size=conf.get('id_cache_size', 50000),
+                            warm_id_cache=conf.get('warm_id_cache', True),
+                            delete_grace=conf.get('delete_grace', 600),
+                            retry_attempts=conf.get('retry_attempts', 8),
+                            prepare_cache_bytes=conf.get('prepare_cache_bytes', 2 << 30),
+                            prepare_processes=conf.get('prepare_processes'),
+                            name=name,
+                            uploads=uploads,
+                            transcodes=transcodes)
 
 def start_service(confname, port, gm_email, gm_password):
     """Attempt to start the service on locally on port *port*, using config *confname*.
 
     Return True if the service started, or an error message."""
 
-    #Read in the config.
-    conf = read_config_file(confname)
-    mp_conf = mp_confs[conf['mp_type']]
-    api = Api()
-    api.login(gm_email, gm_password) #need to use init here
-    
+    return start_services([confname], port, {gm_email: gm_password})
+
+def start_services(confnames, port, accounts):
+    """Attempt to start one service locally on port *port*, running a library for each config in *confnames*
+    (by default, every config that's been set up).
+
+    *accounts* maps each Google Music email to its password. A library syncs to the account named by the
+    'email' of its config; when only one account is given, every library uses it. Libraries on the same
+    account share one login, one LimitedApi (paced by the first of their configs) and one upload pool,
+    so the account's limits hold however many libraries feed it. Every library transcodes on one process pool,
+    with the most prepare_processes of any config. Each library keeps its own poll thread, which sleeps on
+    its own mediaplayer db between changes.
+
+    Return True if the service started, or an error message."""
+
+    confnames = confnames or list_confs()
+    if not confnames:
+        return "Could not start service: no configurations have been set up."
+
+    #Read in the configs, and group them by account.
+    confs = OrderedDict((confname, read_config_file(confname)) for confname in confnames)
+    by_account = OrderedDict()
+    for confname, conf in confs.items():
+        email = accounts.keys()[0] if len(accounts) == 1 else conf.get('email')
+        if email not in accounts:
+            return "Could not start service: no password given for the account of %s (%s)." % (confname, email)
+        by_account.setdefault(email, []).append(confname)
 
     try:
+        #transcodes are bound by the cores, whichever library they're for
+        processes = [conf.get('prepare_processes') for conf in confs.values()]
+        transcodes = multiprocessing.Pool(None if None in processes else max(processes))
+
+        libraries = OrderedDict()
+        upload_pools = []
+        for email, names in by_account.items():
+            api = Api()
+            api.login(email, accounts[email]) #need to use init here
+
+            upload_workers = max(max(1, confs[confname].get('upload_workers', 1)) for confname in names)
+            api = make_limited_api(api, dict(confs[names[0]], upload_workers=upload_workers))
+            uploads = ThreadPool(upload_workers)
+            upload_pools.append(uploads)
+
+            for confname in names:
+                libraries[confname] = make_poll_thread(confname, confs[confname], api, uploads, transcodes,
+                                                       name=confname if len(confs) > 1 else None)
+
         server = SocketServer.TCPServer(('localhost', port), ServiceHandler)
-        server_thread = threading.Thread(target=server.serve_forever)
-        poll_thread = ChangePollThread(mp_conf.make_connection, api, conf['mp_db_fn'], get_conf_dir(confname), mp_conf.action_pairs)
+        server.libraries = libraries
+        server.stopping = threading.Event()
+        server_thread = threading.Thread(target=server.serve_forever, name='control')
+        supervisor = threading.Thread(target=_supervise, args=(server, libraries.values(), upload_pools, transcodes), name='supervisor')
         server_thread.start()
-        poll_thread.start()
+        supervisor.start()
+        for poll_thread in libraries.values():
+            poll_thread.start()
     except Exception as e:
-        return "Could not start service:", repr(e)
+        return "Could not start service: " + repr(e)
 
     return True
+
+def _supervise(server, poll_threads, upload_pools, transcodes):
+    """Wait for *server* to be asked to shut down, then stop every one of *poll_threads*, the pools they share
+    (*upload_pools*, ThreadPools, and *transcodes*, a multiprocessing Pool) and the server itself.
+
+    Poll threads stop at their next wait, and drop changes still queued for the worker pool, so this only waits for
+    pushes already in progress. TCPServer.shutdown blocks until serve_forever returns, so it's called from here."""
+    server.stopping.wait()
+
+    #libraries shut down on their own are already stopping; they're waited for too, since they share the pools
+    for t in poll_threads:
+        t.stop()
+    for t in poll_threads:
+        t.join()
+
+    for pool in upload_pools:
+        pool.close()
+        pool.join()
+
+    #transcodes still running are abandoned, as when a library closes its own pool
+    transcodes.terminate()
+    transcodes.join()
+
+    server.shutdown()
+    server.server_close()
+
+
+def bootstrap_library(confname, gm_email, gm_password):
+    """Push every item already in the local library for config *confname*. Run this before the service, not alongside it.
+
+    Return True if the bootstrap finished, or an error message."""
+
+    conf = read_config_file(confname)
+    mp_conf = mp_confs[conf['mp_type']]
+    api = Api()
+    api.login(gm_email, gm_password)
+
+    poll_thread = make_poll_thread(confname, conf, api)
+
+    try:
+        return poll_thread.bootstrap(mp_conf.bootstrap) or "Bootstrap was interrupted; run it again to resume."
+    except KeyboardInterrupt:
+        poll_thread.stop()
+        return "Bootstrap was interrupted; run it again to resume."
+    finally:
+        poll_thread.close()
+
+def reconcile_library(confname, gm_email, gm_password, execute=False, delete_orphans=False):
+    """Return the list of Repairs needed to bring the local library for config *confname* and Google Music back in line,
+    or an error message. When *execute* is True, push them too. Run this instead of the service, not alongside it.
+
+    Remote items that nothing maps to are only deleted when *delete_orphans* is True."""
+
+    conf = read_config_file(confname)
+    mp_conf = mp_confs[conf['mp_type']]
+    api = Api()
+    api.login(gm_email, gm_password)
+
+    poll_thread = make_poll_thread(confname, conf, api)
+
+    try:
+        return poll_thread.reconcile(mp_conf.bootstrap, execute, delete_orphans)
+    except KeyboardInterrupt:
+        poll_thread.stop()
+        return "Reconcile was interrupted; run it again to finish."
+    except (CallFailure, GMSyncError) as e:
+        return "Could not reconcile: " + repr(e)
+    finally:
+        poll_thread.close()
+
+def list_dead_letters(confname):
+    """Return the changes for config *confname* that failed too many times to push,
+    as a list of (id, changeId, handler name, localId, attempts, failedAt, lastError)."""
+
+    conf = read_config_file(confname)
+    action_pairs = mp_confs[conf['mp_type']].action_pairs
+    ids = IdDatabase(get_conf_dir(confname) + id_db_fn)
+
+    try:
+        ids.upgrade(get_conf_dir(confname) + change_fn)
+        return [(dl_id, c_id, action_pairs[c_type].handler.__name__, local_id, attempts, failed_at, error)
+                for dl_id, c_id, c_type, local_id, attempts, failed_at, error in ids.get_dead_letters()]
+    finally:
+        ids.close()
+
+def replay_dead_letters(confname, dl_ids=None):
+    """Queue the dead letters with ids *dl_ids* (or all of them) for config *confname* to be pushed again.
+
+    A running service picks them up within a minute. Return the number queued."""
+
+    ids = IdDatabase(get_conf_dir(confname) + id_db_fn)
+
+    try:
+        ids.upgrade(get_conf_dir(confname) + change_fn)
+        moved = ids.replay_dead_letters(dl_ids)
+        ids.commit()
+        return moved
+    finally:
+        ids.close()
@@ -0,0 +1,103 @@
+"""Tests of the service against the fake Api and synthetic library used by the benchmarks (see bench/fakes.py).
+
+gmusicapi still needs to be installed, since the service imports it."""
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from contextlib import closing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'bench'))
+
+from fakes import FakeApi, Library, wait_until_idle
+
+
+class CountingApi(FakeApi):
+    """Counts uploads and playlist deletes, and stops *stop_on_delete* (a poll thread), if set, once a playlist is deleted."""
+
+    def __init__(self, *args, **kwargs):
+        FakeApi.__init__(self, *args, **kwargs)
+        self.uploads = 0
+        self.playlist_deletes = 0
+        self.stop_on_delete = None
+
+    def upload(self, path):
+        res = FakeApi.upload(self, path)
+        with self._lock:
+            self.uploads += 1
+        return res
+
+    def delete_playlist(self, gm_id):
+        FakeApi.delete_playlist(self, gm_id)
+        self.playlist_deletes += 1
+        if self.stop_on_delete is not None:
+            self.stop_on_delete.stop()
+
+
+class StopRestartTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd() #Library changes it off Windows
+        self.root = tempfile.mkdtemp(prefix='sync2gm-test-')
+        self.library = Library(self.root)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def last_change_id(self):
+        with closing(self.library.connect()) as conn:
+            return conn.execute("SELECT max(changeId) FROM sync2gm_Changes").fetchone()[0]
+
+    def count(self, table):
+        with closing(sqlite3.connect(self.library.conf_dir + 'gmids.db')) as conn:
+            return conn.execute("SELECT count(*) FROM %s" % table).fetchone()[0]
+
+    def run_until_idle(self, api, **kwargs):
+        t = self.library.poll_thread(api, **kwargs)
+        t.start()
+        self.assertTrue(wait_until_idle(t, self.last_change_id(), timeout=30))
+        t.stop()
+        t.join()
+
+    def test_stop_with_queued_uploads_then_restart(self):
+        api = CountingApi(upload_latency=0.2)
+
+        with closing(self.library.connect()) as conn:
+            conn.execute("INSERT INTO Playlists VALUES (1, 'playlist')")
+            conn.commit()
+        self.run_until_idle(api)
+        self.assertEqual(self.count('GMPlaylistIds'), 1)
+
+        #One window: three uploads for a single worker, then the playlist delete, which stops the thread.
+        #The first upload is done by then, the second still running and the third queued, so the third is dropped.
+        with closing(self.library.connect()) as conn:
+            self.library.add_songs(conn, 1, 3)
+            conn.execute("DELETE FROM Playlists WHERE IDPlaylist=1")
+            conn.commit()
+
+        t = self.library.poll_thread(api, upload_workers=1)
+        api.stop_on_delete = t
+        t.start()
+        t.join(30)
+        self.assertFalse(t.is_alive())
+        api.stop_on_delete = None
+
+        self.assertEqual(api.uploads, 2)
+        self.assertEqual(self.count('GMSongIds'), 2)
+        self.assertEqual(self.count('GMPlaylistIds'), 0)
+
+        #The checkpoint stayed behind the dropped upload, so the delete after it is replayed.
+        self.run_until_idle(api, upload_workers=1)
+
+        self.assertEqual(api.uploads, 3)
+        self.assertEqual(api.playlist_deletes, 1)
+        self.assertEqual(self.count('GMSongIds'), 3)
+        self.assertEqual(self.count('RetryQueue'), 0)
+        self.assertEqual(self.count('DeadLetters'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()